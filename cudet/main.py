@@ -17,19 +17,36 @@
 
 import argparse
 import csv
+import gc
 import hashlib
+import json
 import logging
+import marshal
 import os
 import re
 import sqlite3
 import sys
+import tempfile
 import urllib2
 import yaml
+from multiprocessing.pool import ThreadPool
 
 from cudet import configuration
 from cudet import nodes
+from cudet import utils
+from cudet import vercmp
+from cudet import versionsdb
 from cudet.utils import interrupt_wrapper
-from cudet.vercmp import vercmp
+from cudet.utils import open_output
+from cudet.vercmp import keycmp
+from cudet.vercmp import verkey
+from cudet.versionsdb import add_package_version
+from cudet.versionsdb import print_mu
+
+
+# bump when the structure of versions_dict changes to invalidate saved
+# versions indexes
+INDEX_FORMAT = 2
 
 
 class Unbuffered(object):
@@ -45,25 +62,62 @@ class Unbuffered(object):
 
 
 def load_versions_dict(conf, nm):
+    mirror = conf['versions_mirror'].rstrip('/')
+    timeout = conf['versions_mirror_timeout']
+
+    def online_url(release, os_platform, ext):
+        return '%s/%s/%s-latest.%s' % (mirror, release, os_platform, ext)
+
     def fetch(url):
         try:
-            return urllib2.urlopen(url).read()
+            return urllib2.urlopen(url, timeout=timeout).read()
         except:
             return None
 
-    def online(release, os_platform, ext):
-        url = ('http://mirror.fuel-infra.org/mcv/mos/%s/'
-               '%s-latest.%s' % (release, os_platform, ext))
-        return fetch(url)
-
-    def update_db(db_file, release, os_platform):
-        ext_db = online(release, os_platform, 'sqlite')
-        if ext_db:
-            open(db_file, 'w').write(ext_db)
-        else:
+    def update_db(db_file, release, os_platform, ext_md5=None):
+        '''Stream the db from the mirror into a temporary file which
+        replaces db_file once complete (and matching ext_md5).'''
+        md5 = hashlib.md5()
+        tmp_file = None
+        try:
+            request = urllib2.urlopen(online_url(release, os_platform,
+                                                 'sqlite'),
+                                      timeout=timeout)
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(db_file))
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: request.read(1 << 20), b''):
+                    md5.update(chunk)
+                    f.write(chunk)
+            if ext_md5 and md5.hexdigest() != ext_md5:
+                raise ValueError('md5 mismatch')
+            os.chmod(tmp_file, 0644)
+            os.rename(tmp_file, db_file)
+        except Exception as e:
+            logging.debug('could not download versions db for MOS %s %s: '
+                          '%s' % (release, os_platform, e))
+            if tmp_file and os.path.exists(tmp_file):
+                os.unlink(tmp_file)
             return False
+        save_file_md5(db_file, md5.hexdigest())
         return True
 
+    def check_db(db_file, release, os_platform):
+        '''Returns the message for the nodes of the db (or None) and
+        whether the db can be used.'''
+        if not os.path.isfile(db_file):
+            if update_db(db_file, release, os_platform):
+                return msg_nodb_ok, True
+            return msg_nodb_fail, False
+        ext_md5 = fetch(online_url(release, os_platform, 'md5'))
+        if not ext_md5:
+            return msg_newer_unkn, True
+        ext_md5 = ext_md5.rstrip('\n')
+        if ext_md5 == file_md5(db_file):
+            return None, True
+        if update_db(db_file, release, os_platform, ext_md5):
+            return msg_newer_ok, True
+        return msg_newer_fail, True
+
     msg_newer_ok = ('a newer versions db for MOS %s %s was found online '
                     'and successfully downloaded.')
     msg_newer_unkn = ('could not check for versions db updates for '
@@ -97,99 +151,202 @@ def load_versions_dict(conf, nm):
             dbs[r][p]['dir'] = os.path.join(db_dir, r)
         if 'file' not in dbs[r][p]:
             dbs[r][p]['file'] = os.path.join(db_dir, r, '%s.sqlite' % p)
+    checks = []
     for r in dbs:
         for p in dbs[r]:
             d = dbs[r][p]['dir']
-            f = dbs[r][p]['file']
             if not os.path.isdir(d):
                 os.makedirs(d)
-            if f in db_files:
-                continue
-            if os.path.isfile(f):
-                ext_md5 = online(r, p, 'md5')
-                if ext_md5:
-                    ext_md5 = ext_md5.rstrip('\n')
-                    int_db = open(f, 'rb').read()
-                    int_md5 = hashlib.md5(int_db).hexdigest()
-                    if ext_md5 != int_md5:
-                        if update_db(f, r, p):
-                            for n in dbs[r][p]['nodes']:
-                                output_add(output, n, msg_newer_ok % (r, p))
-                        else:
-                            for n in dbs[r][p]['nodes']:
-                                output_add(output, n, msg_newer_fail % (r, p))
-                else:
-                    for n in dbs[r][p]['nodes']:
-                        output_add(output, n, msg_newer_unkn % (r, p))
-                db_files.add(f)
-            else:
-                if update_db(f, r, p):
-                    for n in dbs[r][p]['nodes']:
-                        output_add(output, n, msg_nodb_ok % (r, p))
-                    db_files.add(f)
-                else:
-                    for n in dbs[r][p]['nodes']:
-                        output_add(output, n, msg_nodb_fail % (r, p))
+            checks.append((dbs[r][p]['file'], r, p))
+    # all dbs are checked at once, a slow mirror delays the start by its
+    # timeout at most once
+    pool = ThreadPool(max(len(checks), 1))
+    try:
+        results = pool.map(lambda check: check_db(*check), checks)
+    finally:
+        pool.close()
+    for (f, r, p), (msg, usable) in zip(checks, results):
+        if msg:
+            for n in dbs[r][p]['nodes']:
+                output_add(output, n, msg % (r, p))
+        if usable:
+            db_files.add(f)
     versions_dict = {}
+    if conf['versions_lazy']:
+        for r in dbs:
+            for p in dbs[r]:
+                if dbs[r][p]['file'] in db_files:
+                    if r not in versions_dict:
+                        versions_dict[r] = {}
+                    versions_dict[r][p] = LazyVersions(dbs[r][p]['file'],
+                                                       r, p)
+        return versions_dict, output
     for db_file in db_files:
-        import_db = sqlite3.connect(db_file)
-        import_dbc = import_db.cursor()
-        r = import_dbc.execute('''
-            SELECT
-                id,
-                job_id,
-                release,
-                mu,
-                os,
-                package_name,
-                package_version,
-                package_filename
-            FROM versions
-            ORDER BY package_name ASC, mu DESC
-            ''')
-        for row in r.fetchall():
-            release = row[2]
-            mu = row[3]
-            os_platform = row[4]
-            p_name = row[5]
-            p_version = row[6]
-            if release not in versions_dict:
-                versions_dict[release] = {}
-            vdr = versions_dict[release]
-            if os_platform not in vdr:
-                vdr[os_platform] = {}
-            if p_name not in vdr[os_platform]:
-                vdr[os_platform][p_name] = {}
-            p_dict = vdr[os_platform][p_name]
-            if 'mu' not in p_dict:
-                p_dict['mu'] = set()
-            p_dict['mu'].add(mu)
-            if 'versions' not in p_dict:
-                p_dict['versions'] = {}
-            if p_version not in p_dict['versions']:
-                p_dict['versions'][p_version] = set()
-            if 'max_version' not in p_dict:
-                p_dict['max_version'] = p_version
-            else:
-                r = vercmp(os_platform, p_version, p_dict['max_version'])
-                max_v_mus = p_dict['versions'][p_dict['max_version']]
-                if r > 0 and mu not in max_v_mus:
-                    '''Should never happen since the MU order is DESC.
-                    If this happens then it means that package version was
-                    lowered in a subsequent MU, which is against our policy as
-                    of Feb 2016.'''
-                    logging.warning('Downgrade detected in release '
-                                    '%s, os %s, %s to %s, package %s - '
-                                    "version '%s' was downgraded to '%s'\n"
-                                    % (release, os_platform, print_mu(mu),
-                                       print_mu(min(max_v_mus)), p_name,
-                                       p_version, p_dict['max_version']))
-                elif r > 0:
-                    p_dict['max_version'] = p_version
-            p_dict['versions'][p_version].add(mu)
+        load_versions_db(db_file, versions_dict,
+                         use_index=conf['versions_index'])
     return versions_dict, output
 
 
+def read_versions_db(db_file, versions_dict):
+    import_db = sqlite3.connect(db_file)
+    for row in versionsdb.select_versions(import_db).fetchall():
+        release = row[0]
+        os_platform = row[2]
+        if release not in versions_dict:
+            versions_dict[release] = {}
+        vdr = versions_dict[release]
+        if os_platform not in vdr:
+            vdr[os_platform] = {}
+        add_package_version(vdr[os_platform], *row)
+    return versions_dict
+
+
+class LazyVersions(object):
+    '''Packages dict of one release and os which reads packages from the
+    versions db only when they are looked up or prefetched.'''
+    # stay well below SQLITE_MAX_VARIABLE_NUMBER (999 by default)
+    batch_size = 500
+
+    def __init__(self, db_file, release, os_platform):
+        self.db_file = db_file
+        self.release = release
+        self.os_platform = os_platform
+        self.db = None
+        self.db_pid = None
+        self.packages = {}
+        self.absent = set()
+
+    def prefetch(self, names):
+        names = [n for n in set(names)
+                 if n not in self.packages and n not in self.absent]
+        if not names:
+            return
+        if self.db_pid != os.getpid():
+            # a connection may not be used by processes forked after it
+            # was opened (parallel analysis)
+            self.db = sqlite3.connect(self.db_file)
+            self.db_pid = os.getpid()
+        for i in range(0, len(names), self.batch_size):
+            batch = names[i:i + self.batch_size]
+            r = versionsdb.select_versions(self.db, batch)
+            for row in r:
+                add_package_version(self.packages, self.release, row[1],
+                                    self.os_platform, *row[3:])
+        self.absent.update(n for n in names if n not in self.packages)
+
+    def __contains__(self, name):
+        self.prefetch([name])
+        return name in self.packages
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return self.packages[name]
+
+
+def prefetch_versions(versions_dict, node_list):
+    '''Read all packages found in collected package lists of the nodes
+    into the LazyVersions of their release and os.'''
+    names = {}
+    for node in node_list:
+        vdr = versions_dict.get(node.release, {})
+        vd = vdr.get(node.os_platform)
+        command = 'packagelist-' + node.os_platform
+        if (not isinstance(vd, LazyVersions) or command not in node.mapscr or
+                not os.path.exists(node.mapscr[command])):
+            continue
+        with open_output(node.mapscr[command]) as packagelist:
+            reader = csv.reader(packagelist, delimiter='\t')
+            names.setdefault(vd, set()).update(row[0] for row in reader)
+    for vd, vd_names in names.items():
+        vd.prefetch(vd_names)
+
+
+def load_versions_db(db_file, versions_dict, use_index=True):
+    '''Add the contents of a versions db to versions_dict.
+
+    With use_index the result of read_versions_db is also saved into a
+    compiled index next to the db file, which is reused as long as the md5
+    of the db file does not change. The index is a marshal dump, which
+    loads several times faster than a pickle, but is only valid for the
+    Python version which wrote it.'''
+    if not use_index:
+        return read_versions_db(db_file, versions_dict)
+    index_file = db_file + '.index'
+    db_md5 = file_md5(db_file)
+    index_format = [INDEX_FORMAT, sys.version, db_md5]
+    try:
+        with open(index_file, 'rb') as f:
+            # nothing but plain containers is loaded, no cycles to collect
+            gc.disable()
+            try:
+                index = marshal.load(f)
+            finally:
+                gc.enable()
+        if index['format'] == index_format:
+            return merge_versions_dict(versions_dict, index['versions'])
+    except Exception:
+        # missing, outdated or broken index, rebuilding
+        pass
+    db_versions = read_versions_db(db_file, {})
+    index = {'format': index_format, 'versions': db_versions}
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(index_file))
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(index, f)
+        os.rename(tmp_file, index_file)
+    except (IOError, OSError) as e:
+        logging.warning('could not save versions index %s: %s' %
+                        (index_file, e))
+    return merge_versions_dict(versions_dict, db_versions)
+
+
+def merge_versions_dict(versions_dict, db_versions):
+    for release, platforms in db_versions.items():
+        versions_dict.setdefault(release, {}).update(platforms)
+    return versions_dict
+
+
+def file_md5(filename):
+    '''md5 of a file, cached in <filename>.digest for the size and mtime
+    of the file it was computed for.'''
+    st = os.stat(filename)
+    try:
+        with open(filename + '.digest', 'r') as f:
+            digest = json.load(f)
+        if digest['size'] == st.st_size and digest['mtime'] == st.st_mtime:
+            return digest['md5']
+    except Exception:
+        pass
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    save_file_md5(filename, md5.hexdigest())
+    return md5.hexdigest()
+
+
+def save_file_md5(filename, md5):
+    st = os.stat(filename)
+    try:
+        with open(filename + '.digest', 'w') as f:
+            json.dump({'size': st.st_size, 'mtime': st.st_mtime, 'md5': md5},
+                      f)
+    except (IOError, OSError) as e:
+        logging.warning('could not save digest of %s: %s' % (filename, e))
+
+
+def md5_cache_env_vars(conf):
+    '''env_vars passing the md5 cache settings to the md5 verification
+    scripts.'''
+    if not conf['md5_cache']:
+        return []
+    env_vars = ['md5_cache=%s' % conf['md5_cache']]
+    if conf['full_verify']:
+        env_vars.append('full_verify=true')
+    return env_vars
+
+
 def node_manager_init(conf):
     logging.basicConfig(level=logging.WARNING,
                         format='%(asctime)s %(levelname)s %(message)s')
@@ -263,86 +420,184 @@ def fstrip(text_file):
     return [line.rstrip('\n') for line in text_file]
 
 
-def verify_versions(node, versions_dict, output=None):
+def custom_package(node, p_name, p_version):
+    '''Entry of node.custom_packages for the installed version of a package,
+    the reasons it is custom are added by the analyses.'''
+    if not hasattr(node, 'custom_packages'):
+        node.custom_packages = {}
+    if p_name not in node.custom_packages:
+        node.custom_packages[p_name] = {}
+        node.custom_packages[p_name]['reasons'] = set()
+    node.custom_packages[p_name]['version'] = p_version
+    return node.custom_packages[p_name]
+
+
+def node_versions_db(node, versions_dict):
+    '''Versions database of the release and os of the node, None if there is
+    no data for them.'''
     if (node.release not in versions_dict or (node.os_platform not in
                                               versions_dict[node.release])):
-        return output_add(output, node,
-                          ('the database does not have any data for MOS '
-                           'release %s for %s!' % (str(node.release),
-                                                   str(node.os_platform))))
-    msg_custom = "installed version '%s' is not part of MOS %s"
-    vd = versions_dict[node.release][node.os_platform]
+        return None
+    return versions_dict[node.release][node.os_platform]
+
+
+def read_packagelist(node, vd):
+    '''Parse the collected package list of the node once, returns
+    ([(name, version, versions db entry)], None) for the packages known to
+    the versions database or (None, message) if there is no data.'''
     command = 'packagelist-' + node.os_platform
     if command not in node.mapscr:
-        return output_add(output, node, 'versions data was not collected!')
+        return None, 'versions data was not collected!'
     if not os.path.exists(node.mapscr[command]):
-        return output_add(output, node, 'versions data output file missing!')
-    if os.stat(node.mapscr[command]).st_size == 0:
-        return output_add(output, node,
-                          'versions data empty, you may want to re-run!')
-    with open(node.mapscr[command], 'r') as packagelist:
-        reader = csv.reader(packagelist, delimiter='\t')
-        if not hasattr(node, 'custom_packages'):
-            node.custom_packages = {}
-        for p_name, p_version in reader:
+        return None, 'versions data output file missing!'
+    empty = True
+    packages = []
+    with open_output(node.mapscr[command]) as packagelist:
+        for p_name, p_version in csv.reader(packagelist, delimiter='\t'):
+            empty = False
             if p_name in vd:
-                if p_version not in vd[p_name]['versions']:
-                    if p_name not in node.custom_packages:
-                        node.custom_packages[p_name] = {}
-                        node.custom_packages[p_name]['reasons'] = set()
-                    node.custom_packages[p_name]['version'] = p_version
-                    if 0 not in vd[p_name]['mu']:
-                        node.custom_packages[p_name]['reasons'].add('upstream')
-                    else:
-                        node.custom_packages[p_name]['reasons'].add('version')
-                        output_add(output, node,
-                                   {p_name: str(msg_custom % (str(p_version),
-                                                              node.release))})
+                packages.append((p_name, p_version, vd[p_name]))
+    if empty:
+        return None, 'versions data empty, you may want to re-run!'
+    return packages, None
+
+
+def output_findings(output, node, findings):
+    '''Add the [(message, key)] findings of an analysis of the node to the
+    output.'''
+    for message, key in findings:
+        output_add(output, node, message, key)
     return output
 
 
-def verify_md5_builtin_show_results(conf, node, output=None):
+def version_findings(node, packages):
+    msg_custom = "installed version '%s' is not part of MOS %s"
+    findings = []
+    for p_name, p_version, vd_p in packages:
+        if p_version not in vd_p['versions']:
+            p_data = custom_package(node, p_name, p_version)
+            if 0 not in vd_p['mu']:
+                p_data['reasons'].add('upstream')
+            else:
+                p_data['reasons'].add('version')
+                findings.append(({p_name: str(msg_custom % (str(p_version),
+                                                            node.release))},
+                                 None))
+    return findings
+
+
+def verify_versions(node, versions_dict, output=None):
+    vd = node_versions_db(node, versions_dict)
+    if vd is None:
+        return output_add(output, node,
+                          ('the database does not have any data for MOS '
+                           'release %s for %s!' % (str(node.release),
+                                                   str(node.os_platform))))
+    packages, message = read_packagelist(node, vd)
+    if message:
+        return output_add(output, node, message)
+    return output_findings(output, node, version_findings(node, packages))
+
+
+def md5_verify_script(node):
+    '''Name of the builtin md5 verification script which was run on the
+    node, the -fast variant has the same output format.'''
     command = 'packages-md5-verify-'+node.os_platform
+    if command + '-fast' in node.mapscr:
+        return command + '-fast'
+    return command
+
+
+# compiled md5 exclusion filters by filter file, shared between nodes
+_md5_filters = {}
+
+# regexps which may not keep their meaning when combined with others
+_NOT_COMBINABLE = re.compile(r'\\\d|\(\?P|\(\?[a-zA-Z]')
+# literal start of a regexp, without a last character which is repeated
+_LITERAL_PREFIX = re.compile(r'\^?([^.^$*+?{}\[\]\\|()]*)')
+
+
+def literal_prefix(pattern):
+    '''Literal text every line matched by the regexp starts with.'''
+    if '|' in pattern or '(?' in pattern:
+        return ''
+    match = _LITERAL_PREFIX.match(pattern)
+    prefix = match.group(1)
+    if pattern[match.end():match.end() + 1] in ('*', '+', '?', '{'):
+        prefix = prefix[:-1]
+    return prefix
+
+
+def compile_any(patterns):
+    '''Compiled regexps, one of which matches where one of the patterns
+    does. The patterns are combined into a single regexp unless some use
+    backreferences, named groups or flags, or there are too many groups
+    for one regexp.'''
+    if not any(_NOT_COMBINABLE.search(p) for p in patterns):
+        try:
+            return [re.compile('|'.join('(?:%s)' % p for p in patterns))]
+        except (re.error, AssertionError, OverflowError):
+            pass
+    return [re.compile(p) for p in patterns]
+
+
+class MD5Filter(object):
+    '''Exclusion regexps of an md5 filter file. Regexps are grouped by
+    their literal prefix, which is mostly a package name, so a line is only
+    matched against the groups of the prefixes it starts with.'''
+
+    def __init__(self, patterns):
+        groups = {}
+        for pattern in patterns:
+            groups.setdefault(literal_prefix(pattern), []).append(pattern)
+        self.groups = dict((prefix, compile_any(group))
+                           for prefix, group in groups.items())
+        self.lengths = sorted(set(len(prefix) for prefix in self.groups))
+
+    def match(self, line):
+        for length in self.lengths:
+            regexps = self.groups.get(line[:length])
+            if regexps and any(r.match(line) for r in regexps):
+                return True
+        return False
+
+
+def md5_filter(filename):
+    '''MD5Filter of a filter file, read and compiled once.'''
+    if filename not in _md5_filters:
+        patterns = []
+        if os.path.isfile(filename):
+            with open(filename, 'r') as ex_file:
+                patterns = fstrip(ex_file)
+        _md5_filters[filename] = MD5Filter(patterns)
+    return _md5_filters[filename]
+
+
+def md5_findings(node, conf):
+    command = md5_verify_script(node)
     if command not in node.mapscr:
-        return output_add(output, node, 'builtin md5 data was not collected!')
+        return [('builtin md5 data was not collected!', None)]
     if not os.path.exists(node.mapscr[command]):
-        return output_add(output, node,
-                          'builtin md5 data output file missing!')
+        return [('builtin md5 data output file missing!', None)]
     ex_filename = os.path.join(conf['cudet_db_dir'],
                                'md5/%s/%s.filter' % (node.release,
                                                      node.os_platform))
-    # value-less dict
-    ex_list = []
-    if os.path.isfile(ex_filename):
-        with open(ex_filename, 'r') as ex_file:
-            for line in fstrip(ex_file):
-                ex_list.append(line)
-    if os.stat(node.mapscr[command]).st_size > 0:
-        with open(node.mapscr[command], 'r') as md5_file:
-            for line in fstrip(md5_file):
-                excluded = False
-                for ex_regexp in ex_list:
-                    if re.match(ex_regexp, line):
-                        excluded = True
-                        break
-                if excluded:
-                    continue
-                p_name, p_version, details = line.split('\t')
-                if not hasattr(node, 'custom_packages'):
-                    node.custom_packages = {}
-                if p_name not in node.custom_packages:
-                    node.custom_packages[p_name] = {}
-                    node.custom_packages[p_name]['reasons'] = set()
-                node.custom_packages[p_name]['version'] = p_version
-                node.custom_packages[p_name]['reasons'].add('builtin-md5')
-                output_add(output, node,
-                           str(details).strip(),
-                           '%s %s' % (str(p_name), str(p_version)))
-    return output
+    ex_filter = md5_filter(ex_filename)
+    findings = []
+    with open_output(node.mapscr[command]) as md5_file:
+        for line in fstrip(md5_file):
+            if ex_filter.match(line):
+                continue
+            p_name, p_version, details = line.split('\t')
+            p_data = custom_package(node, p_name, p_version)
+            p_data['reasons'].add('builtin-md5')
+            findings.append((str(details).strip(),
+                             '%s %s' % (str(p_name), str(p_version))))
+    return findings
 
 
-def print_mu(mu):
-    return 'MU'+str(mu) if mu > 0 else 'GA'
+def verify_md5_builtin_show_results(conf, node, output=None):
+    return output_findings(output, node, md5_findings(node, conf))
 
 
 def get_reasons_string(reasons_list):
@@ -352,20 +607,19 @@ def get_reasons_string(reasons_list):
         return 'custom ['+', '.join(reasons_list)+']'
 
 
-def mu_safety_check(node, versions_dict, output=None):
+def mu_safety_findings(node, vd):
+    findings = []
 
     def _compare_with_mvd(vd_package, p_name, p_data):
         p_version = p_data['version']
         p_reasons = get_reasons_string(p_data['reasons'])
-        r = vercmp(node.os_platform, vd_package['max_version'], p_version)
+        r = keycmp(vd_package['max_key'], verkey(node.os_platform, p_version))
         mu = min(vd_package['versions'][vd_package['max_version']])
         if r > 0 and p_reasons != 'upstream':
-            output_add(
-                output,
-                node,
+            findings.append((
                 str("%s %s '%s' will be overwritten by %s version '%s'" % (
                     p_reasons, p_name, p_version, print_mu(mu),
-                    vd_package['max_version'])))
+                    vd_package['max_version'])), None))
         elif r < 0 or (r == 0 and p_reasons == 'upstream'):
             # case in brackets is highly unlikely
             if p_reasons == 'upstream':
@@ -375,83 +629,196 @@ def mu_safety_check(node, versions_dict, output=None):
             else:
                 message = ("%s %s '%s' may prevent %s version '%s' from "
                            'being installed')
-            output_add(output, node,
-                       str(message % (p_reasons, p_name, p_version,
-                                      print_mu(mu),
-                                      vd_package['max_version'])))
+            findings.append((str(message % (p_reasons, p_name, p_version,
+                                            print_mu(mu),
+                                            vd_package['max_version'])),
+                             None))
 
-    if hasattr(node, 'custom_packages'):
+    if vd is not None and hasattr(node, 'custom_packages'):
         for p_name, p_data in node.custom_packages.items():
-            if node.release in versions_dict:
-                if node.os_platform in versions_dict[node.release]:
-                    vd = versions_dict[node.release][node.os_platform]
-                    if p_name in vd:
-                        vd_p = vd[p_name]
-                        if max(vd_p['mu']) > 0:
-                            _compare_with_mvd(vd_p, p_name, p_data)
-    return output
+            if p_name in vd:
+                vd_p = vd[p_name]
+                if max(vd_p['mu']) > 0:
+                    _compare_with_mvd(vd_p, p_name, p_data)
+    return findings
 
 
-def update_candidates(node, versions_dict, output=None):
+def mu_safety_check(node, versions_dict, output=None):
+    return output_findings(output, node, mu_safety_findings(
+        node, node_versions_db(node, versions_dict)))
+
+
+def update_findings(node, packages):
     # shortening fucntion name for pep8's sake...
     grs = get_reasons_string
-    if (node.release not in versions_dict or (node.os_platform not in
-                                              versions_dict[node.release])):
-            return output_add(output, node,
-                              ('the database does not have any data for MOS '
-                               'release %s, os %s!' % (str(node.release),
-                                                       str(node.os_platform))))
-    vd = versions_dict[node.release][node.os_platform]
-    command = 'packagelist-'+node.os_platform
-    if command not in node.mapscr:
-        return output_add(output, node, 'versions data was not collected!')
-    if not os.path.exists(node.mapscr[command]):
-        return output_add(output, node, 'versions data output file missing!')
-    if os.stat(node.mapscr[command]).st_size == 0:
-        return output_add(output, node,
-                          'versions data empty, you may want to re-run!')
-    with open(node.mapscr[command], 'r') as packagelist:
-        reader = csv.reader(packagelist, delimiter='\t')
-        for p_name, p_version in reader:
-            if p_name in vd:
-                vd_package = vd[p_name]
-                r = vercmp(node.os_platform, vd_package['max_version'],
-                           p_version)
-                p_state = ''
-                if (hasattr(node, 'custom_packages') and
-                        p_name in node.custom_packages):
-                    p_state = ('%s ' %
-                               (grs(node.custom_packages[p_name]['reasons'])))
-                if p_version in vd_package['versions']:
-                    p_mu = min(vd_package['versions'][p_version])
-                    if p_mu:
-                        print_p_mu = 'MU%s' % (p_mu)
-                    else:
-                        print_p_mu = 'GA'
-                else:
-                    print_p_mu = 'N/A'
-                if r > 0 or (r < 0 and p_state == 'upstream '):
-                    mus = vd_package['versions'][vd_package['max_version']]
-                    mu = min(mus)
-                    output_add(output, node,
-                               {'%s%s' % (p_state, p_name): str(
-                                   "%s to %s (from '%s' to '%s')" %
-                                   (print_p_mu,
-                                    print_mu(mu),
-                                    p_version,
-                                    vd_package['max_version']))})
-    return output
+    findings = []
+    for p_name, p_version, vd_package in packages:
+        r = keycmp(vd_package['max_key'], verkey(node.os_platform, p_version))
+        p_state = ''
+        if (hasattr(node, 'custom_packages') and
+                p_name in node.custom_packages):
+            p_state = ('%s ' %
+                       (grs(node.custom_packages[p_name]['reasons'])))
+        if p_version in vd_package['versions']:
+            p_mu = min(vd_package['versions'][p_version])
+            if p_mu:
+                print_p_mu = 'MU%s' % (p_mu)
+            else:
+                print_p_mu = 'GA'
+        else:
+            print_p_mu = 'N/A'
+        if r > 0 or (r < 0 and p_state == 'upstream '):
+            mus = vd_package['versions'][vd_package['max_version']]
+            mu = min(mus)
+            findings.append(({'%s%s' % (p_state, p_name): str(
+                "%s to %s (from '%s' to '%s')" %
+                (print_p_mu,
+                 print_mu(mu),
+                 p_version,
+                 vd_package['max_version']))}, None))
+    return findings
 
 
-def perform(description, function, nm, args, ok_message):
+def update_candidates(node, versions_dict, output=None):
+    vd = node_versions_db(node, versions_dict)
+    if vd is None:
+        return output_add(output, node,
+                          ('the database does not have any data for MOS '
+                           'release %s, os %s!' % (str(node.release),
+                                                   str(node.os_platform))))
+    packages, message = read_packagelist(node, vd)
+    if message:
+        return output_add(output, node, message)
+    return output_findings(output, node, update_findings(node, packages))
+
+
+# sections of the report: (analyze_node findings key, description, message
+# printed if no node has findings)
+SECTIONS = [('versions', '  Versions verification analysis', 'OK'),
+            ('md5', '  Built-in md5 verification analysis', 'OK'),
+            ('updates', '  Potential updates', 'ALL NODES UP-TO-DATE')]
+
+
+def analyze_node(node, versions_dict, conf):
+    '''Findings of all analyses of the node by SECTIONS key, as
+    [(message, key)] for output_add. The package list is parsed once and
+    shared by the analyses, custom packages found by the version and md5
+    analyses are reported by the update one.'''
+    findings = {}
+    vd = node_versions_db(node, versions_dict)
+    packages = None
+    if vd is None:
+        findings['versions'] = [
+            ('the database does not have any data for MOS release %s for '
+             '%s!' % (str(node.release), str(node.os_platform)), None)]
+        findings['updates'] = [
+            ('the database does not have any data for MOS release %s, os '
+             '%s!' % (str(node.release), str(node.os_platform)), None)]
+    else:
+        packages, message = read_packagelist(node, vd)
+        if message:
+            findings['versions'] = findings['updates'] = [(message, None)]
+        else:
+            findings['versions'] = version_findings(node, packages)
+    findings['md5'] = md5_findings(node, conf)
+    if packages is not None:
+        findings['updates'] = update_findings(node, packages)
+    return findings
+
+
+def print_cache_stats():
+    for name, stats in sorted(vercmp.cache_stats().items()):
+        sys.stderr.write('%s cache: %d hits, %d misses (hit rate %.1f%%), '
+                         'size %d of %d, %d evictions\n' % (
+                             name, stats['hits'], stats['misses'],
+                             stats['hit_rate'] * 100, stats['size'],
+                             stats['maxsize'], stats['evictions']))
+
+
+def analyze_nodes(function, node_list, processes):
+    '''[function(node)] of the nodes, in order. With more than one process
+    the nodes are shared among forked processes, which inherit the nodes and
+    the versions dicts copy-on-write, only the results are sent back. The
+    custom packages found by the processes are copied to the nodes.'''
+    if processes < 2 or len(node_list) < 2:
+        return [function(node) for node in node_list]
+
+    def analyze_share(share):
+        return [(function(node), getattr(node, 'custom_packages', None))
+                for node in share]
+    processes = min(processes, len(node_list))
+    run_items = [utils.RunItem(target=analyze_share,
+                               args={'share': node_list[i::processes]})
+                 for i in range(processes)]
+    results = [None] * len(node_list)
+    for i, share_results in enumerate(utils.run_batch(run_items, processes)):
+        for j, (result, custom_packages) in enumerate(share_results):
+            index = i + j * processes
+            results[index] = result
+            if custom_packages is not None:
+                node_list[index].custom_packages = custom_packages
+    return results
+
+
+def node_fingerprint(node):
+    '''Digest of everything analyze_node reads about the node: its release
+    and os and the collected package list and md5 verification outputs,
+    nodes with the same fingerprint have the same findings. Outputs are
+    hashed decompressed, as the same output compressed on different nodes
+    or rebuilt from a delta does not have the same bytes.'''
+    outputs = []
+    for command in ('packagelist-' + node.os_platform,
+                    md5_verify_script(node)):
+        filename = node.mapscr.get(command)
+        if filename and os.path.exists(filename):
+            md5 = hashlib.md5()
+            with open_output(filename) as lines:
+                for line in lines:
+                    md5.update(line)
+            outputs.append((command, md5.hexdigest()))
+        else:
+            outputs.append((command, filename is not None))
+    return hashlib.md5(repr((node.release, node.os_platform,
+                             outputs))).hexdigest()
+
+
+def analyze_unique_nodes(function, node_list, processes, known,
+                         prepare=None):
+    '''analyze_nodes for nodes with a fingerprint which was not analyzed yet,
+    the other nodes get copies of the result and of the custom packages of
+    the node with the same fingerprint. known maps fingerprints to
+    (result, custom packages) and is updated. prepare is called with the
+    nodes which are analyzed, before they are.'''
+    fingerprints = [node_fingerprint(node) for node in node_list]
+    new = []
+    for node, fingerprint in zip(node_list, fingerprints):
+        if fingerprint not in known:
+            known[fingerprint] = None
+            new.append((fingerprint, node))
+    new_nodes = [node for fingerprint, node in new]
+    analyzed = set(new_nodes)
+    if prepare and new_nodes:
+        prepare(new_nodes)
+    for (fingerprint, node), result in zip(
+            new, analyze_nodes(function, new_nodes, processes)):
+        known[fingerprint] = (result, getattr(node, 'custom_packages', None))
+    results = []
+    for node, fingerprint in zip(node_list, fingerprints):
+        result, custom_packages = known[fingerprint]
+        if node not in analyzed:
+            # not shared, the report would be dumped with yaml aliases,
+            # results are plain containers which marshal copies much
+            # faster than copy.deepcopy
+            result = marshal.loads(marshal.dumps(result))
+            if custom_packages is not None:
+                node.custom_packages = marshal.loads(
+                    marshal.dumps(custom_packages))
+        results.append(result)
+    return results
+
+
+def print_results(description, output, ok_message):
     sys.stdout.write(description+': ')
-    output = {}
-    if not args:
-        args = {}
-    for node in nm.nodes.values():
-        args['node'] = node
-        args['output'] = output
-        function(**args)
     if output:
         pretty_print(output)
     else:
@@ -469,16 +836,25 @@ def main(argv=None):
     parser.add_argument('-c', '--config',
                         help='Path to user config file',
                         default=None)
+    parser.add_argument('--full-verify',
+                        help=('Hash all packaged files on the nodes, ignoring '
+                              'and rewriting the md5 caches'),
+                        action='store_true')
     if argv is None:
         argv = sys.argv
     args = parser.parse_args(argv[1:])
     try:
         conf = configuration.get_config(args.config)
+        if args.full_verify:
+            conf['full_verify'] = True
+        conf['env_vars'] = conf['env_vars'] + md5_cache_env_vars(conf)
         nm = node_manager_init(conf)
     except Exception as e:
         print("[ERROR] Could't get node list.")
         raise e
 
+    if conf['vercmp_cache_size']:
+        vercmp.enable_cache(conf['vercmp_cache_size'])
     versions_dict, output = load_versions_dict(conf, nm)
     if not versions_dict:
         print("[ERROR] Could't load databases.")
@@ -486,16 +862,44 @@ def main(argv=None):
     if output:
         pretty_print(output)
 
+    # every node is analyzed as soon as its data is collected, while other
+    # nodes are still being processed, unless the analysis is parallel
+    outputs = dict((section, {}) for section, description, ok in SECTIONS)
+    analyzed = set()
+    # findings by node fingerprint, nodes with the same package state are
+    # only analyzed once
+    known = {}
+
+    def prepare(node_list):
+        # before forking in parallel mode, shared by all analysis processes
+        if conf['versions_lazy']:
+            prefetch_versions(versions_dict, node_list)
+
+    def analyze(node_list, processes=0):
+        all_findings = analyze_unique_nodes(
+            lambda node: analyze_node(node, versions_dict, conf),
+            node_list, processes, known, prepare)
+        for node, findings in zip(node_list, all_findings):
+            for section, output in outputs.items():
+                output_findings(output, node, findings[section])
+            analyzed.add(node)
+
     sys.stdout.write('Collecting data from %d nodes: ' % len(nm.nodes))
-    nm.run_commands(conf['outdir'], fake=args.fake)
+    if conf['analysis_processes'] > 1:
+        nm.run_commands(conf['outdir'], fake=args.fake)
+    else:
+        nm.run_commands(conf['outdir'], fake=args.fake,
+                        callback=lambda node: analyze([node]))
     print('DONE')
+    # all nodes in parallel mode, otherwise the nodes which were not
+    # collected from (filtered out)
+    analyze([node for node in nm.nodes.values() if node not in analyzed],
+            conf['analysis_processes'])
     print('Results:')
-    perform('  Versions verification analysis', verify_versions, nm,
-            {'versions_dict': versions_dict}, 'OK')
-    perform('  Built-in md5 verification analysis',
-            verify_md5_builtin_show_results, nm, {'conf': conf}, 'OK')
-    perform('  Potential updates', update_candidates, nm,
-            {'versions_dict': versions_dict}, 'ALL NODES UP-TO-DATE')
+    for section, description, ok_message in SECTIONS:
+        print_results(description, outputs[section], ok_message)
+    if conf['vercmp_cache_size']:
+        print_cache_stats()
     return 0
 
 
@@ -12,13 +12,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
 import copy
 import datetime
+import gzip
+import hashlib
 import logging
 import json
 import os
 import shutil
 import sys
+import tempfile
+import time
 
 try:
     from fuelclient.client import Client as FuelClient
@@ -33,6 +38,12 @@ except:
 
 from cudet import utils
 
+# stat of the package database and a digest of the installed packages
+PROBE_CMD = ("stat -c '%n %s %Y %Z %i' /var/lib/dpkg/status "
+             "/var/lib/rpm/Packages 2>/dev/null; "
+             "{ dpkg-query -W 2>/dev/null || rpm -qa 2>/dev/null | sort; } "
+             "| md5sum")
+
 
 class Node(object):
     ckey = 'cmds'
@@ -185,6 +196,7 @@ class Node(object):
             utils.mdir(ddir)
         self.cmds = sorted(self.cmds)
         mapcmds = {}
+        jobs = []
         for c in self.cmds:
             for cmd in c:
                 dfile = os.path.join(ddir, 'node-%s-%s-%s' %
@@ -193,24 +205,15 @@ class Node(object):
                         dfile += self.outputs_timestamp_str
                 self.logger.info('outfile: %s' % dfile)
                 mapcmds[cmd] = dfile
-                if not fake:
-                    outs, errs, code = utils.ssh_node(ip=self.ip,
-                                                      command=c[cmd],
-                                                      ssh_opts=self.ssh_opts,
-                                                      env_vars=self.env_vars,
-                                                      timeout=self.timeout,
-                                                      prefix=self.prefix)
-                    self.check_code(code, 'exec_cmd', c[cmd], errs, ok_codes)
-                    try:
-                        with open(dfile, 'w') as df:
-                            df.write(outs.encode('utf-8'))
-                    except:
-                        self.logger.error("can't write to file %s" %
-                                          dfile)
+                jobs.append({'command': c[cmd],
+                             'env_vars': self.env_vars,
+                             'dfile': dfile,
+                             'label': c[cmd]})
         if self.scripts:
             utils.mdir(ddir)
         scripts = sorted(self.scripts)
         mapscr = {}
+        compress = self.compress_outputs and utils.compression_formats()
         for scr in scripts:
             if type(scr) is dict:
                 env_vars = scr.values()[0]
@@ -228,22 +231,219 @@ class Node(object):
                     dfile += self.outputs_timestamp_str
             self.logger.info('outfile: %s' % dfile)
             mapscr[scr] = dfile
-            if not fake:
-                outs, errs, code = utils.ssh_node(ip=self.ip,
-                                                  filename=f,
-                                                  ssh_opts=self.ssh_opts,
-                                                  env_vars=env_vars,
-                                                  timeout=self.timeout,
-                                                  prefix=self.prefix)
-                self.check_code(code, 'exec_cmd', 'script %s' % f, errs,
-                                ok_codes)
-                try:
-                    with open(dfile, 'w') as df:
-                        df.write(outs.encode('utf-8'))
-                except:
-                    self.logger.error("can't write to file %s" % dfile)
+            job = {'filename': f,
+                   'env_vars': env_vars,
+                   'dfile': dfile,
+                   'label': 'script %s' % f,
+                   'reusable': any(os.path.basename(f).startswith(p)
+                                   for p in self.reuse_scripts),
+                   'compress': compress}
+            if (self.delta_cache and not fake and
+                    any(os.path.basename(f).startswith(p)
+                        for p in self.delta_scripts)):
+                job['baseline'], md5 = self.delta_baseline(dfile)
+                job['delta'] = (md5, os.path.join(self.delta_cache,
+                                                  os.path.basename(f)))
+            jobs.append(job)
+        if fake:
+            return mapcmds, mapscr
+        reusable = [j for j in jobs if j.get('reusable')]
+        probe = None
+        if reusable and self.reuse_max_age and not self.outputs_timestamp:
+            probe = self.probe()
+            if self.probe_unchanged(probe, reusable, ddir):
+                self.logger.info('node: %s: package database unchanged, '
+                                 'reusing previous outputs' % self.id)
+                jobs = [j for j in jobs if not j.get('reusable')]
+                probe = None
+        results = {}
+        if self.single_session and len(jobs) > 1:
+            results = self.exec_session(jobs)
+        for i, job in enumerate(jobs):
+            if i in results:
+                outs, errs, code = results[i]
+            else:
+                outs, errs, code = self.exec_job(job)
+            written = self.write_output(job, outs)
+            # a delta which cannot be applied (cut short by the timeout...)
+            # never stays in outdir
+            if written and job.get('delta') and not self.apply_delta(job):
+                if code:
+                    self.logger.warning('node: %s: discarding the delta of '
+                                        '%s' % (self.id, job['label']))
+                    os.remove(job['dfile'])
+                    written = False
+                else:
+                    self.logger.warning('node: %s: could not apply the delta '
+                                        'of %s, collecting it again' %
+                                        (self.id, job['label']))
+                    job = dict(job, delta=None)
+                    outs, errs, code = self.exec_job(job)
+                    written = self.write_output(job, outs)
+            self.check_code(code, 'exec_cmd', job['label'], errs, ok_codes)
+            if not written or code and job.get('reusable'):
+                probe = None
+        if probe is not None:
+            self.save_probe(probe, ddir)
         return mapcmds, mapscr
 
+    def write_output(self, job, outs):
+        if outs is None:
+            # written by exec_job
+            return True
+        try:
+            with open(job['dfile'], 'w') as df:
+                if job.get('compress'):
+                    df.write(outs)
+                else:
+                    df.write(outs.encode('utf-8'))
+        except:
+            self.logger.error("can't write to file %s" % job['dfile'])
+            return False
+        return True
+
+    def delta_baseline(self, dfile):
+        '''Lines and md5 of the previous output of a delta job, the node
+        sends a delta against it if it still has the same output.'''
+        if not os.path.exists(dfile):
+            return [], ''
+        with utils.open_output(dfile) as f:
+            lines = list(f)
+        if lines and lines[0].startswith(utils.DELTA_HEADER + ' '):
+            return [], ''
+        return lines, hashlib.md5(''.join(lines)).hexdigest()
+
+    def apply_delta(self, job):
+        '''Rebuild the whole output of a delta job from its baseline if the
+        node sent a delta, False if the result does not have the md5 the
+        node sent.'''
+        with utils.open_output(job['dfile']) as f:
+            lines = list(f)
+        if not lines or not lines[0].startswith(utils.DELTA_HEADER + ' '):
+            return True
+        md5 = lines[0].split()[1]
+        try:
+            lines = utils.apply_rcs_diff(job['baseline'], lines[1:])
+        except (ValueError, IndexError):
+            return False
+        if hashlib.md5(''.join(lines)).hexdigest() != md5:
+            return False
+        try:
+            if job.get('compress'):
+                df = gzip.open(job['dfile'], 'wb')
+            else:
+                df = open(job['dfile'], 'w')
+            with contextlib.closing(df):
+                df.writelines(lines)
+        except IOError:
+            self.logger.error("can't write to file %s" % job['dfile'])
+            return False
+        return True
+
+    def probe_file(self, ddir):
+        return os.path.join(ddir, 'node-%s-%s-probe' % (self.id, self.ip))
+
+    def probe(self):
+        '''Cheap fingerprint of the package database of the node, None if
+        it could not be taken.'''
+        outs, errs, code = utils.ssh_node(ip=self.ip,
+                                          command=PROBE_CMD,
+                                          ssh_opts=self.ssh_opts,
+                                          timeout=self.timeout,
+                                          prefix=self.prefix)
+        if code:
+            self.logger.warning('node: %s: package database probe failed, '
+                                'error: %s' % (self.id, errs))
+            return None
+        return outs
+
+    def probe_unchanged(self, probe, jobs, ddir):
+        '''True if the probe is the same as when the outputs of jobs were
+        last collected, at most reuse_max_age seconds ago.'''
+        if probe is None:
+            return False
+        try:
+            with open(self.probe_file(ddir), 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return False
+        return (state.get('probe') == probe and
+                time.time() - state.get('time', 0) <= self.reuse_max_age and
+                all(os.path.exists(job['dfile']) for job in jobs))
+
+    def save_probe(self, probe, ddir):
+        try:
+            with open(self.probe_file(ddir), 'w') as f:
+                json.dump({'probe': probe, 'time': time.time()}, f)
+        except IOError:
+            self.logger.error("can't write to file %s" %
+                              self.probe_file(ddir))
+
+    def exec_job(self, job):
+        '''Run a command or a script of exec_cmd in its own ssh session.
+        Compressed script outputs are written to the output file as they
+        arrive, outs is None then.'''
+        if 'command' in job:
+            return utils.ssh_node(ip=self.ip,
+                                  command=job['command'],
+                                  ssh_opts=self.ssh_opts,
+                                  env_vars=job['env_vars'],
+                                  timeout=self.timeout,
+                                  prefix=self.prefix)
+        if not job.get('compress') and not job.get('delta'):
+            return utils.ssh_node(ip=self.ip,
+                                  filename=job['filename'],
+                                  ssh_opts=self.ssh_opts,
+                                  env_vars=job['env_vars'],
+                                  timeout=self.timeout,
+                                  prefix=self.prefix)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(utils.job_script(job))
+            f.flush()
+            if not job.get('compress'):
+                return utils.ssh_node(ip=self.ip,
+                                      filename=f.name,
+                                      ssh_opts=self.ssh_opts,
+                                      env_vars=job['env_vars'],
+                                      timeout=self.timeout,
+                                      prefix=self.prefix)
+            outs, errs, code = utils.ssh_node(ip=self.ip,
+                                              filename=f.name,
+                                              ssh_opts=self.ssh_opts,
+                                              env_vars=job['env_vars'],
+                                              timeout=self.timeout,
+                                              outputfile=job['dfile'],
+                                              prefix=self.prefix)
+        return None, errs, code
+
+    def exec_session(self, jobs):
+        '''Run all jobs of exec_cmd in a single ssh session, returns
+        {job index: (outs, errs, code)} for the jobs which completed, the
+        others are left to exec_job.'''
+        # the output is read back from a file as bytes, since compressed
+        # outputs can not be decoded
+        with tempfile.NamedTemporaryFile() as f, \
+                tempfile.NamedTemporaryFile() as output:
+            f.write(utils.pack_session(jobs, self.timeout))
+            f.flush()
+            outs, errs, code = utils.ssh_node(ip=self.ip,
+                                              filename=f.name,
+                                              ssh_opts=self.ssh_opts,
+                                              timeout=(self.timeout *
+                                                       len(jobs)),
+                                              outputfile=output.name,
+                                              prefix=self.prefix)
+            data = output.read()
+        results = utils.unpack_session(
+            data, raw=[i for i, job in enumerate(jobs) if job.get('compress')])
+        if len(results) < len(jobs):
+            self.logger.warning('node: %s: single session ended after %d '
+                                'of %d jobs, exit code %s, error: %s, '
+                                'running the rest separately' %
+                                (self.id, len(results), len(jobs), code,
+                                 errs))
+        return results
+
     def exec_simple_cmd(self, cmd, timeout=15, infile=None, outfile=None,
                         fake=False, ok_codes=None, input=None):
         self.logger.info('node:%s(%s), exec: %s' % (self.id, self.ip, cmd))
@@ -282,6 +482,8 @@ class NodeManager(object):
                 conf.outdir += timestamp_str
         if conf.clean:
             shutil.rmtree(conf.outdir, ignore_errors=True)
+        if conf.ssh_multiplex:
+            utils.enable_ssh_multiplexing(conf.ssh_control_persist)
         if not conf.shell_mode:
             self.rqdir = conf.rqdir
             if (not os.path.exists(self.rqdir)):
@@ -504,7 +706,8 @@ class NodeManager(object):
             if not node.filtered_out:
                 run_items.append(utils.RunItem(target=node.get_release,
                                                key=key))
-        result = utils.run_batch(run_items, 100, dict_result=True)
+        result = utils.run_batch(run_items, 100, dict_result=True,
+                                 backend=self.conf.run_backend)
         for key in result:
             self.nodes[key].release = result[key]
 
@@ -581,14 +784,19 @@ class NodeManager(object):
             return all(checks)
 
     @utils.run_with_lock
-    def run_commands(self, timeout=15, fake=False, maxthreads=100):
+    def run_commands(self, timeout=15, fake=False, maxthreads=100,
+                     callback=None):
+        '''Run commands and scripts on all nodes, callback(node) is called
+        for every node as soon as its outputs are collected.'''
         run_items = []
         for key, node in self.nodes.items():
             if not node.filtered_out:
                 run_items.append(utils.RunItem(target=node.exec_cmd,
                                                args={'fake': fake},
                                                key=key))
-        result = utils.run_batch(run_items, maxthreads, dict_result=True)
-        for key in result:
-            self.nodes[key].mapcmds = result[key][0]
-            self.nodes[key].mapscr = result[key][1]
+        for key, result in utils.run_batch_iter(run_items, maxthreads,
+                                                self.conf.run_backend):
+            self.nodes[key].mapcmds = result[0]
+            self.nodes[key].mapscr = result[1]
+            if callback:
+                callback(self.nodes[key])
@@ -12,22 +12,35 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import atexit
+import contextlib
+import fcntl
+import functools
 import json
 import logging
 import multiprocessing
 import os
 import pipes
+import shutil
 import subprocess
 import sys
 import tempfile
 import threading
+import uuid
 import yaml
+import zlib
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
 from cudet import flock
 
 
 logger = logging.getLogger(__name__)
 
+# run_batch_threads waits for results this many seconds at a time, which
+# keeps the wait interruptible by KeyboardInterrupt
+THREAD_BATCH_POLL = 1
+
 
 def interrupt_wrapper(f):
     def wrapper(*args, **kwargs):
@@ -68,6 +81,15 @@ class RunItem():
         self.logger = logger or logging.getLogger(__name__)
 
 
+class ThreadExit(object):
+    '''SystemExit, KeyboardInterrupt or another BaseException raised by a
+    target in a pool thread. It would end the thread without completing its
+    task, so it is returned instead and raised again by the waiting
+    thread.'''
+    def __init__(self, error):
+        self.error = error
+
+
 class SemaphoreProcess(multiprocessing.Process):
     def __init__(self, semaphore, target, args=None, queue=None, logger=None):
         super(SemaphoreProcess, self).__init__()
@@ -94,7 +116,13 @@ class SemaphoreProcess(multiprocessing.Process):
             self.logger.debug('semaphore released')
 
 
-def run_batch(item_list, maxthreads, dict_result=False):
+def run_batch(item_list, maxthreads, dict_result=False, backend='process'):
+    if backend == 'thread':
+        return run_batch_threads(item_list, maxthreads, dict_result)
+    if backend != 'process':
+        logger.critical('unknown run_batch backend: %s' % backend)
+        sys.exit(42)
+
     def cleanup():
         logger.debug('cleanup processes')
         for run_item in item_list:
@@ -131,6 +159,153 @@ def run_batch(item_list, maxthreads, dict_result=False):
         raise KeyboardInterrupt()
 
 
+def run_batch_threads(item_list, maxthreads, dict_result=False):
+    '''run_batch with a pool of threads instead of a process and a queue
+    per item, for targets which mostly wait on subprocesses (ssh). Targets
+    run in this process, so they must be thread safe.'''
+    def run(run_item):
+        try:
+            return run_item.target(**(run_item.args or {}))
+        except Exception as error:
+            logger.exception(error)
+            return error
+        except BaseException as error:
+            return ThreadExit(error)
+        finally:
+            logger.debug('finished call: %s' % run_item.target)
+
+    pool = ThreadPool(max(min(maxthreads, len(item_list)), 1))
+    try:
+        async_result = pool.map_async(run, item_list)
+        while not async_result.ready():
+            async_result.wait(THREAD_BATCH_POLL)
+        results = async_result.get()
+        for result in results:
+            if isinstance(result, ThreadExit):
+                pool.terminate()
+                raise result.error
+        for run_item, result in zip(item_list, results):
+            run_item.result = result
+            if isinstance(result, Exception):
+                logger.critical('%s, exiting' % result)
+                pool.terminate()
+                sys.exit(42)
+        pool.close()
+        if dict_result:
+            result = {}
+            for run_item in item_list:
+                result[run_item.key] = run_item.result
+            return result
+        else:
+            return [run_item.result for run_item in item_list]
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise KeyboardInterrupt()
+
+
+def _indexed_call(index, target, **kwargs):
+    return index, target(**kwargs)
+
+
+def run_batch_iter(item_list, maxthreads, backend='process'):
+    '''Like run_batch, but yields (key, result) of every item as soon as
+    it is done, in completion order, so that results can be processed while
+    slower items are still running.'''
+    if backend == 'thread':
+        return _run_batch_iter_threads(item_list, maxthreads)
+    if backend != 'process':
+        logger.critical('unknown run_batch backend: %s' % backend)
+        sys.exit(42)
+    return _run_batch_iter_processes(item_list, maxthreads)
+
+
+def _run_batch_iter_processes(item_list, maxthreads):
+    def start(i):
+        run_item = item_list[i]
+        semaphore.acquire(True)
+        p = SemaphoreProcess(
+            target=functools.partial(_indexed_call, i, run_item.target),
+            semaphore=semaphore,
+            args=run_item.args,
+            queue=queue)
+        run_item.process = p
+        p.start()
+
+    def cleanup():
+        logger.debug('cleanup processes')
+        for run_item in item_list:
+            if run_item.process:
+                run_item.process.terminate()
+    semaphore = multiprocessing.BoundedSemaphore(maxthreads)
+    # a single queue for all items, results come in as items complete
+    queue = multiprocessing.Queue()
+    # processes are forked by the thread consuming the results, between
+    # results, so that no other thread of this process can hold a lock
+    # (logging...) at the time, which the child would never see released
+    started = 0
+    done = 0
+    try:
+        while started < min(maxthreads, len(item_list)):
+            start(started)
+            started += 1
+        while done < len(item_list):
+            result = queue.get()
+            if isinstance(result, Exception):
+                logger.critical('%s, exiting' % result)
+                sys.exit(42)
+            i, result = result
+            run_item = item_list[i]
+            run_item.result = result
+            run_item.process.join()
+            run_item.process = None
+            done += 1
+            if started < len(item_list):
+                start(started)
+                started += 1
+            yield run_item.key, run_item.result
+    finally:
+        # interrupted or closed before all items were done
+        if done < len(item_list):
+            cleanup()
+
+
+def _run_batch_iter_threads(item_list, maxthreads):
+    def run(indexed_item):
+        i, run_item = indexed_item
+        try:
+            return i, run_item.target(**(run_item.args or {}))
+        except Exception as error:
+            logger.exception(error)
+            return i, error
+        except BaseException as error:
+            return i, ThreadExit(error)
+        finally:
+            logger.debug('finished call: %s' % run_item.target)
+
+    pool = ThreadPool(max(min(maxthreads, len(item_list)), 1))
+    done = 0
+    try:
+        results = pool.imap_unordered(run, enumerate(item_list))
+        while done < len(item_list):
+            try:
+                i, result = results.next(THREAD_BATCH_POLL)
+            except multiprocessing.TimeoutError:
+                continue
+            if isinstance(result, ThreadExit):
+                raise result.error
+            run_item = item_list[i]
+            run_item.result = result
+            if isinstance(result, Exception):
+                logger.critical('%s, exiting' % result)
+                sys.exit(42)
+            done += 1
+            yield run_item.key, result
+        pool.close()
+    finally:
+        if done < len(item_list):
+            pool.terminate()
+
+
 def load_json_file(filename):
     """
     Loads json data from file
@@ -180,6 +355,9 @@ def mdir(directory):
             sys.exit(3)
 
 
+_popen_lock = threading.Lock()
+
+
 def launch_cmd(cmd, timeout, input=None, ok_codes=None):
     def _timeout_terminate(pid):
         try:
@@ -189,11 +367,18 @@ def launch_cmd(cmd, timeout, input=None, ok_codes=None):
             pass
 
     logger.info('launching cmd %s' % cmd)
-    p = subprocess.Popen(cmd,
-                         shell=True,
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
+    with _popen_lock:
+        p = subprocess.Popen(cmd,
+                             shell=True,
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        # commands launched by other threads (run_batch_threads) must not
+        # inherit our ends of the pipes, or they would not see EOF until
+        # those commands exit
+        for f in (p.stdin, p.stdout, p.stderr):
+            flags = fcntl.fcntl(f, fcntl.F_GETFD)
+            fcntl.fcntl(f, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
     timeout_killer = None
     try:
         timeout_killer = threading.Timer(timeout, _timeout_terminate, [p.pid])
@@ -225,6 +410,86 @@ def launch_cmd(cmd, timeout, input=None, ok_codes=None):
     return outs, errs, p.returncode
 
 
+class SSHControlPool(object):
+    '''One shared ssh connection per node ip, through OpenSSH ControlMaster
+    sockets. The first ssh_node call to a node starts its master connection
+    explicitly, later calls (from any process forked after the pool was
+    created) reuse it without a handshake. Masters exit after persist idle
+    seconds, or when the pool is closed, which happens at exit at the
+    latest.'''
+
+    def __init__(self, persist=60):
+        self.persist = persist
+        # unix socket paths are limited to ~100 characters, keep it short
+        self.dir = tempfile.mkdtemp(prefix='cudet-ssh-')
+        self.pid = os.getpid()
+        atexit.register(self.close)
+
+    def socket(self, ip):
+        return os.path.join(self.dir, ip)
+
+    def start(self, ip, ssh_opts, timeout):
+        '''Start the master connection to ip unless it is running. ssh puts
+        it in the background once connected, with all standard streams on
+        /dev/null and no other descriptor inherited, so that it does not
+        keep the pipes of the caller or of other threads open. Concurrent
+        callers wait for the first one. An ip which the master could not
+        connect to is marked as failed and not tried again, its commands
+        connect on their own.'''
+        socket = self.socket(ip)
+        with open(socket + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(socket) or os.path.exists(socket + '.failed'):
+                return
+            cmd = ("timeout '%s' ssh -fN -oControlMaster=yes "
+                   "-oControlPath='%s' -oControlPersist=%s %s '%s'" %
+                   (timeout, socket, self.persist, ssh_opts, ip))
+            with open(os.devnull, 'r+') as devnull:
+                code = subprocess.call(cmd, shell=True, stdin=devnull,
+                                       stdout=devnull, stderr=devnull,
+                                       close_fds=True)
+            if code:
+                logger.debug('could not start ssh master connection to %s, '
+                             'exit code %s' % (ip, code))
+                open(socket + '.failed', 'w').close()
+
+    def ssh_opts(self, ip):
+        '''Options of commands using the master connection to ip, they
+        connect on their own if it is not running.'''
+        return ['-oControlMaster=no', "-oControlPath='%s'" % self.socket(ip)]
+
+    def close(self):
+        '''Stop all master connections, only in the process which created
+        the pool.'''
+        if os.getpid() != self.pid or not os.path.isdir(self.dir):
+            return
+        with open(os.devnull, 'w') as devnull:
+            for ip in os.listdir(self.dir):
+                if ip.endswith(('.lock', '.failed')):
+                    continue
+                logger.debug('closing ssh master connection to %s' % ip)
+                subprocess.call(['ssh', '-S', self.socket(ip), '-O', 'exit',
+                                 ip], stdout=devnull, stderr=devnull)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+_ssh_pool = None
+
+
+def enable_ssh_multiplexing(persist=60):
+    global _ssh_pool
+    if not _ssh_pool:
+        _ssh_pool = SSHControlPool(persist)
+    return _ssh_pool
+
+
+def disable_ssh_multiplexing():
+    global _ssh_pool
+    if _ssh_pool:
+        _ssh_pool.close()
+    _ssh_pool = None
+
+
 def ssh_node(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
              filename=None, inputfile=None, outputfile=None,
              ok_codes=None, input=None, prefix=None):
@@ -242,6 +507,9 @@ def ssh_node(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
                env_vars, timeout)
     else:
         logger.info("exec ssh")
+        if _ssh_pool:
+            _ssh_pool.start(ip, ssh_opts, timeout)
+            ssh_opts = ' '.join([ssh_opts] + _ssh_pool.ssh_opts(ip))
         bstr = "timeout '%s' ssh -t -T %s '%s' '%s' " % (
                timeout, ssh_opts, ip, env_vars)
     if filename is None:
@@ -262,6 +530,215 @@ def ssh_node(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
     return launch_cmd(cmd, timeout, input=input, ok_codes=ok_codes)
 
 
+SESSION_FRAME = 'CUDET-FRAME'
+
+
+def pack_session(jobs, timeout):
+    '''Bash script running the commands and scripts of Node.exec_cmd jobs
+    one after another. The result of each job is written as a frame: a
+    "CUDET-FRAME <index> <exit code> <stdout size> <stderr size>" line
+    followed by stdout and stderr, see unpack_session.'''
+    lines = ['__cudet_dir="$(mktemp -d)" || exit 1',
+             'trap \'rm -rf "$__cudet_dir"\' EXIT',
+             '__cudet_frame() {',
+             '    printf \'%s %%s %%s %%s %%s\\n\' "$1" "$2" \\' %
+             SESSION_FRAME,
+             '        $(wc -c < "$__cudet_dir/out") \\',
+             '        $(wc -c < "$__cudet_dir/err")',
+             '    cat "$__cudet_dir/out" "$__cudet_dir/err"',
+             '}']
+    redirects = '> "$__cudet_dir/out" 2> "$__cudet_dir/err"'
+    for i, job in enumerate(jobs):
+        env_vars = job['env_vars'] or ''
+        if type(env_vars) is list:
+            env_vars = ' '.join(env_vars)
+        if 'command' in job:
+            lines.append("%s timeout '%s' bash -c %s < /dev/null %s" %
+                         (env_vars, timeout, pipes.quote(job['command']),
+                          redirects))
+        else:
+            script = job_script(job)
+            eof = 'CUDET-EOF-%s' % uuid.uuid4().hex
+            lines.append("%s timeout '%s' bash -s %s << '%s'" %
+                         (env_vars, timeout, redirects, eof))
+            lines.append(script.rstrip('\n'))
+            lines.append(eof)
+        lines.append('__cudet_frame %d $?' % i)
+    return '\n'.join(lines) + '\n'
+
+
+def unpack_session(data, raw=()):
+    '''Split the output of a pack_session script into
+    {job index: (outs, errs, code)}, a truncated output yields the
+    complete frames only. outs of the jobs in raw are left undecoded.'''
+    results = {}
+    pos = 0
+    while True:
+        end = data.find('\n', pos)
+        if end < 0:
+            break
+        header = data[pos:end].split()
+        if len(header) != 5 or header[0] != SESSION_FRAME:
+            break
+        i, code, out_size, err_size = [int(v) for v in header[1:]]
+        out_end = end + 1 + out_size
+        err_end = out_end + err_size
+        if err_end > len(data):
+            break
+        outs = data[end + 1:out_end]
+        results[i] = (outs if i in raw else outs.decode('utf-8'),
+                      data[out_end:err_end].decode('utf-8').rstrip('\n'),
+                      code)
+        pos = err_end
+    return results
+
+
+# commands compressing the output of scripts on the nodes, in order of
+# preference, with the magic bytes their outputs start with
+COMPRESSORS = [('zstd', 'zstd -q -c', '\x28\xb5\x2f\xfd'),
+               ('gzip', 'gzip -c', '\x1f\x8b')]
+
+
+def compression_formats():
+    '''Formats of COMPRESSORS which outputs can be read back in, zstd
+    needs the zstd command.'''
+    return [name for name, command, magic in COMPRESSORS
+            if name != 'zstd' or find_executable('zstd')]
+
+
+def compressed_script(script, formats):
+    '''Bash script running script with its output compressed by the first
+    of formats available on the node, or left uncompressed if none is. The
+    exit code is the one of script.'''
+    commands = [pipes.quote(command) for name, command, magic in COMPRESSORS
+                if name in formats]
+    eof = 'CUDET-EOF-%s' % uuid.uuid4().hex
+    return '\n'.join(['for __cudet_c in %s cat; do' % ' '.join(commands),
+                      '    command -v "${__cudet_c%% *}" > /dev/null && break',
+                      'done',
+                      "bash -s << '%s' | $__cudet_c" % eof,
+                      script.rstrip('\n'),
+                      eof,
+                      'exit ${PIPESTATUS[0]}']) + '\n'
+
+
+DELTA_HEADER = 'CUDET-DELTA'
+
+
+def delta_script(script, baseline, cache_file):
+    '''Bash script running script and keeping its output in cache_file on
+    the node. If script succeeded and the output cached by the previous run
+    has the md5 baseline, a DELTA_HEADER line with the md5 of the new output
+    is sent followed by diff -n of the two, otherwise the whole output.'''
+    eof = 'CUDET-EOF-%s' % uuid.uuid4().hex
+    cache_file = pipes.quote(cache_file)
+    return '\n'.join([
+        '__cudet_new="$(mktemp)" || exit 1',
+        'trap \'rm -f "$__cudet_new"\' EXIT',
+        "bash -s > \"$__cudet_new\" << '%s'" % eof,
+        script.rstrip('\n'),
+        eof,
+        '__cudet_code=$?',
+        '__cudet_old="$(md5sum < %s 2> /dev/null)"' % cache_file,
+        '__cudet_md5="$(md5sum < "$__cudet_new")"',
+        'if [ "$__cudet_code" = 0 ] && [ -n %s ] &&' %
+        pipes.quote(baseline),
+        '        [ "${__cudet_old%%%% *}" = %s ]; then' %
+        pipes.quote(baseline),
+        '    echo "%s ${__cudet_md5%%%% *}"' % DELTA_HEADER,
+        '    diff -n %s "$__cudet_new"' % cache_file,
+        'else',
+        '    cat "$__cudet_new"',
+        'fi',
+        'if [ "$__cudet_code" = 0 ]; then',
+        '    mkdir -p "$(dirname %s)" 2> /dev/null &&' % cache_file,
+        '        cp "$__cudet_new" %s 2> /dev/null' % cache_file,
+        'fi',
+        'exit $__cudet_code']) + '\n'
+
+
+def apply_rcs_diff(lines, diff):
+    '''Lines of the file which diff -n of lines turned them into.'''
+    result = []
+    pos = 0
+    diff = iter(diff)
+    for command in diff:
+        line, count = [int(v) for v in command[1:].split()]
+        if command[0] == 'd':
+            result.extend(lines[pos:line - 1])
+            pos = line - 1 + count
+        elif command[0] == 'a':
+            result.extend(lines[pos:line])
+            pos = line
+            result.extend(next(diff) for i in range(count))
+        else:
+            raise ValueError('unknown diff command %s' % command)
+    result.extend(lines[pos:])
+    return result
+
+
+def job_script(job):
+    '''Script of a Node.exec_cmd job as it is run on the node.'''
+    with open(job['filename'], 'r') as f:
+        script = f.read()
+    if job.get('delta'):
+        script = delta_script(script, *job['delta'])
+    if job.get('compress'):
+        script = compressed_script(script, job['compress'])
+    return script
+
+
+def output_format(filename):
+    '''Compression format of a collected output, None if it is not
+    compressed.'''
+    with open(filename, 'rb') as f:
+        head = f.read(4)
+    for name, command, magic in COMPRESSORS:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def _gunzip_lines(f, chunk_size=1048576):
+    '''Lines of a gzip file, a truncated file (script killed by timeout)
+    yields the lines up to where it ends.'''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    rest = ''
+    for chunk in iter(lambda: f.read(chunk_size), ''):
+        try:
+            data = decompressor.decompress(chunk)
+        except zlib.error:
+            break
+        lines = (rest + data).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+@contextlib.contextmanager
+def open_output(filename):
+    '''Open a collected output for reading its lines, compressed outputs
+    are decompressed transparently.'''
+    output_f = output_format(filename)
+    if output_f == 'gzip':
+        with open(filename, 'rb') as f:
+            yield _gunzip_lines(f)
+    elif output_f == 'zstd':
+        with open(os.devnull, 'w') as devnull:
+            p = subprocess.Popen(['zstd', '-d', '-c', '-q', filename],
+                                 stdout=subprocess.PIPE, stderr=devnull)
+            try:
+                yield p.stdout
+            finally:
+                p.stdout.close()
+                p.wait()
+    else:
+        with open(filename, 'r') as f:
+            yield f
+
+
 # wrap non-list into list
 def w_list(value):
     return value if type(value) == list else [value]
@@ -1,4 +1,5 @@
 import re
+import threading
 
 
 def rpm_vercmp(a, b):
@@ -154,7 +155,8 @@ def deb_vercmp(a, b):
         elif int(a_epoch.groups()[0]) > 0:
             return a_newer
         a = a[2:]
-        b = b[2:]
+        if b_epoch:
+            b = b[2:]
     elif b_epoch:
         if int(b_epoch.groups()[0]) > 0:
             return b_newer
@@ -194,3 +196,220 @@ def vercmp(os, a, b):
         return rpm_vercmp(a, b)
     if os == 'ubuntu':
         return deb_vercmp(a, b)
+
+
+def keycmp(a, b):
+    '''Compare two keys returned by rpm_verkey / deb_verkey, the result
+    has the same meaning as the result of vercmp.'''
+    return (a > b) - (a < b)
+
+
+def rpm_verkey(v):
+    '''Parse an RPM version once into an immutable key (a tuple).
+    Comparing two keys gives the same result as rpm_vercmp on the
+    original strings, so keys can be computed once and compared or sorted
+    many times.'''
+    if not v:
+        return (0,)
+    epoch = re.match('^(-?\d):', v)
+    tokens = []
+    for token in re.findall('[a-zA-Z]+|[0-9]+|~', v):
+        if token == '~':
+            tokens.append((0,))
+        elif token.isdigit():
+            tokens.append((3, int(token)))
+        else:
+            tokens.append((2, token))
+    # end of the list is newer than '~' but older than anything else
+    tokens.append((1,))
+    return (1, int(epoch.groups()[0]) if epoch else 0, tuple(tokens))
+
+
+# order of non-digit characters used by deb_vercmp: '~' first, then end of
+# string (and digits), then other characters by their code, then letters.
+# deb_vercmp compares letters as strings against integers, which puts them
+# after everything else in Python 2, and its letters range excludes 'z'.
+_DEB_LETTER_BASE = 0x110000 + 256
+_DEB_RUNS = re.compile('([^0-9]*)([0-9]*)')
+
+
+def _deb_order(c):
+    if c == '~':
+        return -1
+    if ('A' <= c <= 'Z') or ('a' <= c < 'z'):
+        return _DEB_LETTER_BASE + ord(c)
+    return ord(c) + 256
+
+
+# orders of the non-digit runs, there are few distinct ones ('.', '-',
+# '~mos', 'ubuntu', ...) so each is computed once
+_deb_run_orders = {}
+
+
+def _deb_part_key(s):
+    '''Key for the upstream version or the revision part, mirrors the
+    cmp() helper of deb_vercmp.'''
+    if not s:
+        return (0,)
+    pairs = []
+    for alpha, digits in _DEB_RUNS.findall(s):
+        if not alpha and not digits:
+            continue
+        orders = _deb_run_orders.get(alpha)
+        if orders is None:
+            orders = tuple(_deb_order(c) for c in alpha) + (0,)
+            _deb_run_orders[alpha] = orders
+        pairs.append((orders, int(digits) if digits else 0))
+    # a missing part compares as an empty non-digit part followed by 0
+    empty = ((0,), 0)
+    while pairs and pairs[-1] == empty:
+        pairs.pop()
+    # each element carries the sign of its tail compared to an endless
+    # sequence of empty parts, so that keys of different length compare
+    # the same way as deb_vercmp pads the shorter string
+    key = []
+    tail = 0
+    for pair in reversed(pairs):
+        key.append(pair + (tail,))
+        tail = (pair > empty) - (pair < empty) or tail
+    key.append(tail)
+    key.reverse()
+    return (1, tuple(key))
+
+
+def deb_verkey(v):
+    '''Parse a Debian version once into an immutable key (a tuple).
+    Comparing two keys gives the same result as deb_vercmp on the
+    original strings.'''
+    if not v:
+        return (0,)
+    epoch = re.match('^(\d):', v)
+    if epoch:
+        v = v[2:]
+    version = revision = None
+    parts = re.match('^([^-].+?)?(?:-([^-]+))?$', v)
+    if parts:
+        version, revision = parts.groups()
+    return (1, int(epoch.groups()[0]) if epoch else 0,
+            _deb_part_key(version), _deb_part_key(revision))
+
+
+def verkey(os, v):
+    if _caches:
+        return _caches['verkey'](os, v)
+    return _verkey(os, v)
+
+
+def _verkey(os, v):
+    if os == 'centos':
+        return rpm_verkey(v)
+    if os == 'ubuntu':
+        return deb_verkey(v)
+
+
+def vercmp_batch(os, pairs):
+    '''Compare many (a, b) version pairs of one OS at once, returns a list
+    of vercmp results (-1, 0 or 1) in the order of pairs.
+
+    Every distinct version is parsed once and encoded as its rank among
+    all distinct versions, so the comparisons become integer
+    comparisons.'''
+    pairs = list(pairs)
+    if not pairs:
+        return []
+    keys = {}
+    for a, b in pairs:
+        for v in (a, b):
+            if v not in keys:
+                keys[v] = verkey(os, v)
+    ranks = {}
+    rank = -1
+    last = None
+    for v in sorted(keys, key=keys.get):
+        if rank < 0 or keys[v] != last:
+            rank += 1
+            last = keys[v]
+        ranks[v] = rank
+    return [(ranks[a] > ranks[b]) - (ranks[a] < ranks[b]) for a, b in pairs]
+
+
+class LRUCache(object):
+    '''Size-bounded memoization of a function with LRU eviction.
+
+    Safe to share between threads, each process (e.g. workers forked by
+    utils.run_batch) gets its own copy with its own statistics.'''
+    PREV, NEXT, KEY, RESULT = 0, 1, 2, 3
+
+    def __init__(self, function, maxsize):
+        self.function = function
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.map = {}
+            # circular doubly linked list, root.NEXT is the oldest entry
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None]
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __call__(self, *args):
+        with self.lock:
+            link = self.map.get(args)
+            if link is not None:
+                # move to the most recently used end
+                link[self.PREV][self.NEXT] = link[self.NEXT]
+                link[self.NEXT][self.PREV] = link[self.PREV]
+                last = self.root[self.PREV]
+                last[self.NEXT] = self.root[self.PREV] = link
+                link[self.PREV] = last
+                link[self.NEXT] = self.root
+                self.hits += 1
+                return link[self.RESULT]
+            self.misses += 1
+        result = self.function(*args)
+        with self.lock:
+            if args in self.map:
+                # computed meanwhile by another thread
+                return result
+            last = self.root[self.PREV]
+            link = [last, self.root, args, result]
+            last[self.NEXT] = self.root[self.PREV] = self.map[args] = link
+            if len(self.map) > self.maxsize:
+                oldest = self.root[self.NEXT]
+                self.root[self.NEXT] = oldest[self.NEXT]
+                oldest[self.NEXT][self.PREV] = self.root
+                del self.map[oldest[self.KEY]]
+                self.evictions += 1
+        return result
+
+    def stats(self):
+        with self.lock:
+            calls = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / calls if calls else 0.0,
+                    'size': len(self.map),
+                    'maxsize': self.maxsize,
+                    'evictions': self.evictions}
+
+
+_caches = {}
+
+
+def enable_cache(maxsize=65536):
+    '''Memoize verkey (by (os, v)), keeping at most maxsize entries. The
+    analysis compares versions through their keys (keycmp), so only the
+    keys are worth caching.'''
+    _caches['verkey'] = LRUCache(_verkey, maxsize)
+
+
+def disable_cache():
+    _caches.clear()
+
+
+def cache_stats():
+    return dict((name, cache.stats()) for name, cache in _caches.items())
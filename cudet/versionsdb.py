@@ -0,0 +1,237 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''Versions databases, shared by cudet and the db generators in util/.
+
+Schema 1 (PRAGMA user_version 0) is a single "versions" table with release
+and os repeated in every row and no indexes.
+
+Schema 2 keeps release and os once in "meta", the rows in an indexed
+"packages" table with a UNIQUE constraint used for deduplication and the
+max version of every package with its earliest MU in "package_max".
+A "versions" view with the columns of schema 1 is kept so that older cudet
+versions can still read databases downloaded from the mirror.'''
+
+import logging
+
+from cudet.vercmp import keycmp
+from cudet.vercmp import verkey
+
+
+SCHEMA_VERSION = 2
+
+SCHEMA = [
+    '''CREATE TABLE sources
+    (
+        id INTEGER PRIMARY KEY,
+        source TEXT UNIQUE
+    )''',
+    '''CREATE TABLE meta
+    (
+        release TEXT,
+        os TEXT
+    )''',
+    '''CREATE TABLE packages
+    (
+        id INTEGER PRIMARY KEY,
+        source_id INTEGER,
+        job_id INTEGER,
+        mu INTEGER,
+        package_name TEXT,
+        package_version TEXT,
+        package_filename TEXT,
+        UNIQUE (mu, package_name, package_version, package_filename)
+    )''',
+    '''CREATE INDEX packages_name_version
+    ON packages (package_name, package_version)''',
+    '''CREATE INDEX packages_mu ON packages (mu)''',
+    '''CREATE VIEW versions AS
+    SELECT
+        packages.id AS id,
+        packages.source_id AS source_id,
+        packages.job_id AS job_id,
+        meta.release AS release,
+        packages.mu AS mu,
+        meta.os AS os,
+        packages.package_name AS package_name,
+        packages.package_version AS package_version,
+        packages.package_filename AS package_filename
+    FROM packages, meta''',
+    '''CREATE TABLE package_max
+    (
+        package_name TEXT PRIMARY KEY,
+        max_version TEXT,
+        mu INTEGER
+    )''',
+]
+
+
+def schema_version(db):
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    return version if version else 1
+
+
+def create_schema(db, release, os_platform):
+    for statement in SCHEMA:
+        db.execute(statement)
+    db.execute('INSERT INTO meta (release, os) VALUES (?, ?)',
+               (release, os_platform))
+    db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+
+def upgrade_schema(db, release, os_platform):
+    '''Convert a schema 1 database in place, does nothing for schema 2.
+    release and os are taken from the existing rows if there are any.'''
+    if schema_version(db) >= SCHEMA_VERSION:
+        return
+    row = db.execute('SELECT release, os FROM versions LIMIT 1').fetchone()
+    if row:
+        release, os_platform = row
+    db.execute('ALTER TABLE versions RENAME TO versions_1')
+    db.execute('ALTER TABLE sources RENAME TO sources_1')
+    create_schema(db, release, os_platform)
+    db.execute('''
+        INSERT INTO sources (id, source)
+        SELECT id, source FROM sources_1
+        ''')
+    db.execute('''
+        INSERT OR IGNORE INTO packages
+        (
+            id,
+            source_id,
+            job_id,
+            mu,
+            package_name,
+            package_version,
+            package_filename
+        )
+        SELECT
+            id,
+            source_id,
+            job_id,
+            mu,
+            package_name,
+            package_version,
+            package_filename
+        FROM versions_1
+        ''')
+    db.execute('DROP TABLE versions_1')
+    db.execute('DROP TABLE sources_1')
+
+
+def select_versions(db, names=None):
+    '''Rows of (release, mu, os, package_name, package_version,
+    max_version) ordered as add_package_version expects them, max_version
+    is None unless the database has a package_max table. With names only
+    these packages are selected.'''
+    if schema_version(db) >= 2:
+        query = '''
+            SELECT
+                versions.release,
+                versions.mu,
+                versions.os,
+                versions.package_name,
+                versions.package_version,
+                package_max.max_version
+            FROM versions
+            LEFT JOIN package_max
+                ON package_max.package_name = versions.package_name
+            '''
+    else:
+        query = '''
+            SELECT
+                release,
+                mu,
+                os,
+                package_name,
+                package_version,
+                NULL
+            FROM versions
+            '''
+    if names is not None:
+        query += ('WHERE versions.package_name IN (%s)\n' %
+                  ', '.join('?' * len(names)))
+    query += 'ORDER BY versions.package_name ASC, versions.mu DESC, id ASC'
+    return db.execute(query, list(names or []))
+
+
+def update_package_max(db):
+    '''Recompute package_max of a schema 2 database.'''
+    r = db.execute('SELECT release, os FROM meta')
+    release, os_platform = r.fetchone()
+    packages = {}
+    r = db.execute('''
+        SELECT
+            mu,
+            package_name,
+            package_version
+        FROM packages
+        ORDER BY package_name ASC, mu DESC, id ASC
+        ''')
+    for mu, p_name, p_version in r:
+        add_package_version(packages, release, mu, os_platform, p_name,
+                            p_version)
+    db.execute('DELETE FROM package_max')
+    db.executemany('''
+        INSERT INTO package_max (package_name, max_version, mu)
+        VALUES (?, ?, ?)
+        ''', ((p_name, p_dict['max_version'],
+               min(p_dict['versions'][p_dict['max_version']]))
+              for p_name, p_dict in packages.items()))
+
+
+def print_mu(mu):
+    return 'MU'+str(mu) if mu > 0 else 'GA'
+
+
+def add_package_version(packages, release, mu, os_platform, p_name,
+                        p_version, max_version=None):
+    '''Add a versions db row to the packages dict of its release and os,
+    rows of each package must come in descending MU order. max_version is
+    taken from package_max if the database has it, otherwise computed.'''
+    if p_name not in packages:
+        packages[p_name] = {}
+        if max_version is not None:
+            packages[p_name]['max_version'] = max_version
+            packages[p_name]['max_key'] = verkey(os_platform, max_version)
+    p_dict = packages[p_name]
+    if 'mu' not in p_dict:
+        p_dict['mu'] = set()
+    p_dict['mu'].add(mu)
+    if 'versions' not in p_dict:
+        p_dict['versions'] = {}
+    if p_version not in p_dict['versions']:
+        p_dict['versions'][p_version] = set()
+    if 'max_version' not in p_dict:
+        p_dict['max_version'] = p_version
+        p_dict['max_key'] = verkey(os_platform, p_version)
+    elif max_version is None:
+        p_key = verkey(os_platform, p_version)
+        r = keycmp(p_key, p_dict['max_key'])
+        max_v_mus = p_dict['versions'][p_dict['max_version']]
+        if r > 0 and mu not in max_v_mus:
+            '''Should never happen since the MU order is DESC.
+            If this happens then it means that package version was
+            lowered in a subsequent MU, which is against our policy as
+            of Feb 2016.'''
+            logging.warning('Downgrade detected in release '
+                            '%s, os %s, %s to %s, package %s - '
+                            "version '%s' was downgraded to '%s'\n"
+                            % (release, os_platform, print_mu(mu),
+                               print_mu(min(max_v_mus)), p_name,
+                               p_version, p_dict['max_version']))
+        elif r > 0:
+            p_dict['max_version'] = p_version
+            p_dict['max_key'] = p_key
+    p_dict['versions'][p_version].add(mu)
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+'''Compare the per-package and the bulk (-b) insert paths of generate-db.py
+on a synthetic Ubuntu Packages file, both for a GA build and for an MU
+update on top of the GA database.'''
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generate-db.py')
+
+
+def write_packages(filename, count, offset=0):
+    with open(filename, 'w') as f:
+        for i in range(offset, offset + count):
+            name = 'package-%d' % (i,)
+            version = '1:%d.%d.%d-%dubuntu1~mos%d' % (i % 7, i % 13, i % 101,
+                                                      i % 5, i)
+            f.write('Package: %s\n'
+                    'Version: %s\n'
+                    'Architecture: amd64\n'
+                    'Filename: pool/main/%s_%s_amd64.deb\n'
+                    'Size: 1024\n'
+                    'Description: synthetic package %d\n'
+                    '\n' % (name, version, name, version, i))
+
+
+def run(args):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, GENERATOR] + args,
+                              stdout=devnull)
+    return time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-c', '--count', type=int, default=20000,
+                        help='Number of packages in the GA Packages file.')
+    args = parser.parse_args(argv[1:])
+    tmp = tempfile.mkdtemp()
+    try:
+        ga = os.path.join(tmp, 'Packages')
+        mu = os.path.join(tmp, 'Packages-mu')
+        write_packages(ga, args.count)
+        # an MU which updates a tenth of the packages and repeats a few
+        write_packages(mu, args.count // 10, args.count - args.count // 20)
+        print('%d GA packages, %d MU packages' % (args.count,
+                                                   args.count // 10))
+        for mode, flags in (('per-package', []), ('bulk', ['-b'])):
+            # separate caches, otherwise the second mode reuses the
+            # packages parsed by the first one
+            flags = flags + ['-c', os.path.join(tmp, 'cache-' + mode)]
+            ga_db = os.path.join(tmp, 'ga-%s.sqlite' % mode)
+            mu_db = os.path.join(tmp, 'mu-%s.sqlite' % mode)
+            ga_time = run(flags + ['-s', 'ubuntu', '-r', '8.0',
+                                   '-g', 'file://' + ga, '-o', ga_db])
+            mu_time = run(flags + ['-s', 'ubuntu', '-r', '8.0',
+                                   '-u', 'file://' + mu, '-n', '1',
+                                   '-d', 'file://' + ga_db, '-o', mu_db])
+            print('%-12s GA: %6.2fs  MU: %6.2fs' % (mode, ga_time, mu_time))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+'''Compare packages-md5-verify-ubuntu, which runs dpkg --verify for every
+package, with packages-md5-verify-ubuntu-fast on a synthetic dpkg tree with
+modified, missing and config files. Both scripts are pointed to the tree with
+DPKG_ROOT and DPKG_ADMINDIR, dpkg must be installed.'''
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'rq', 'scripts')
+
+
+def write_tree(root, packages, files):
+    admindir = os.path.join(root, 'var', 'lib', 'dpkg')
+    info = os.path.join(admindir, 'info')
+    os.makedirs(info)
+    for d in ('updates', 'triggers'):
+        os.makedirs(os.path.join(admindir, d))
+    open(os.path.join(admindir, 'diversions'), 'w').close()
+    status = open(os.path.join(admindir, 'status'), 'w')
+    for i in range(packages):
+        name = 'package-%d' % (i,)
+        version = '1.%d-%dubuntu1~mos%d' % (i % 13, i % 5, i)
+        lib = os.path.join('usr', 'lib', name)
+        os.makedirs(os.path.join(root, lib))
+        md5sums = []
+        listed = ['/.', '/usr', '/usr/lib', '/' + lib]
+        for j in range(files):
+            filename = os.path.join(lib, 'file-%d' % (j,))
+            data = ('%s %d\n' % (name, j)) * (j * 64 + 1)
+            md5sums.append('%s  %s\n' % (hashlib.md5(data).hexdigest(),
+                                         filename))
+            listed.append('/' + filename)
+            if (i + j) % 97 == 0:
+                # modified
+                data += 'x'
+            elif (i + j) % 89 == 0:
+                # missing
+                continue
+            with open(os.path.join(root, filename), 'w') as f:
+                f.write(data)
+        # outside of /etc, which is never reported
+        conffile = os.path.join(lib, name + '.conf')
+        listed.append('/' + conffile)
+        with open(os.path.join(root, conffile), 'w') as f:
+            f.write('modified %d\n' % (i,))
+        with open(os.path.join(info, name + '.md5sums'), 'w') as f:
+            f.writelines(md5sums)
+        with open(os.path.join(info, name + '.list'), 'w') as f:
+            f.write('\n'.join(listed) + '\n')
+        status.write('Package: %s\n'
+                     'Status: install ok installed\n'
+                     'Priority: optional\n'
+                     'Section: misc\n'
+                     'Maintainer: cudet <cudet@localhost>\n'
+                     'Architecture: amd64\n'
+                     'Version: %s\n'
+                     'Conffiles:\n'
+                     ' /%s %s\n'
+                     'Description: synthetic package %d\n'
+                     '\n' % (name, version, conffile,
+                             hashlib.md5('original\n').hexdigest(), i))
+    status.close()
+    return admindir
+
+
+def run(script, root, admindir, env_vars):
+    env = dict(os.environ, DPKG_ROOT=root, DPKG_ADMINDIR=admindir,
+               **env_vars)
+    start = time.time()
+    output = subprocess.check_output(['bash', os.path.join(SCRIPTS, script)],
+                                     env=env)
+    return time.time() - start, output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-p', '--packages', type=int, default=500,
+                        help='Number of packages in the tree.')
+    parser.add_argument('-f', '--files', type=int, default=20,
+                        help='Number of files of every package.')
+    args = parser.parse_args(argv[1:])
+    tmp = tempfile.mkdtemp()
+    try:
+        admindir = write_tree(tmp, args.packages, args.files)
+        print('%d packages, %d files' % (args.packages,
+                                         args.packages * args.files))
+        cache = os.path.join(tmp, 'var', 'cache', 'cudet', 'md5')
+        for env_vars in ({}, {'skip_config_files': 'false'}):
+            outputs = []
+            # the second run with the md5 cache only hashes changed files
+            for script, cached in (('packages-md5-verify-ubuntu', False),
+                                   ('packages-md5-verify-ubuntu-fast', False),
+                                   ('packages-md5-verify-ubuntu-fast', True),
+                                   ('packages-md5-verify-ubuntu-fast', True)):
+                script_env_vars = dict(env_vars)
+                if cached:
+                    script_env_vars['md5_cache'] = cache
+                elapsed, output = run(script, tmp, admindir, script_env_vars)
+                outputs.append(output)
+                labels = ['%s=%s' % v for v in env_vars.items()]
+                if cached:
+                    labels.append('cached')
+                print('%-32s %-32s %6.2fs, %d lines' %
+                      (script, ' '.join(labels), elapsed,
+                       output.count('\n')))
+            if len(set(outputs)) > 1:
+                print('outputs differ')
+                return 1
+            os.remove(cache)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
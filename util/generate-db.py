@@ -2,14 +2,25 @@
 
 import sys
 import argparse
+import hashlib
+import json
+import marshal
+import multiprocessing
 import urllib2
+import urlparse
 import sqlite3
 import os
+import shutil
 import bz2
 import zlib
 import tempfile
 import xml.etree.ElementTree as ET
-from StringIO import StringIO
+import yaml
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from cudet import versionsdb
 
 releases = ['5.1',
             '5.1.1',
@@ -17,15 +28,564 @@ releases = ['5.1',
             '6.1',
             '7.0',
             '8.0',
+            '9.0',
            ]
 
 systems = ['ubuntu',
            'centos',
           ]
 
+CHUNK_SIZE = 64 * 1024
+FETCH_TIMEOUT = 60
+
+
+def decompress(f, decompressor):
+    '''Decompress the file object f chunk by chunk.'''
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if hasattr(decompressor, 'flush'):
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+class ChunkReader(object):
+    '''Minimal file object over an iterable of strings, for iterparse.'''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buf += chunk
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+def fetch_url(url, cache_dir):
+    '''Return the name of a local file with the contents of url.
+    file:// urls are used in place. Other urls are downloaded into
+    cache_dir under the sha1 of the url, the next download is conditional
+    on the ETag and Last-Modified of the previous one.'''
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == 'file':
+        filename = urllib2.url2pathname(parsed.path)
+        if not os.path.isfile(filename):
+            raise IOError('No such file: %s' % (filename,))
+        return filename
+    filename = os.path.join(cache_dir, hashlib.sha1(url).hexdigest())
+    try:
+        with open(filename + '.json') as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        cached = {}
+    request = urllib2.Request(url)
+    if (os.path.isfile(filename) and
+            os.path.getsize(filename) == cached.get('size')):
+        if cached.get('etag'):
+            request.add_header('If-None-Match', cached['etag'])
+        if cached.get('last_modified'):
+            request.add_header('If-Modified-Since', cached['last_modified'])
+    else:
+        cached = {}
+    try:
+        response = urllib2.urlopen(request, timeout=FETCH_TIMEOUT)
+    except urllib2.HTTPError as e:
+        if e.code == 304 and cached:
+            return filename
+        raise
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as tf:
+        try:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                tf.write(chunk)
+                size += len(chunk)
+            length = response.info().get('Content-Length')
+            if length is not None and int(length) != size:
+                raise IOError('Incomplete download of %s, got %d of %s '
+                              'bytes' % (url, size, length))
+        except Exception:
+            os.unlink(tf.name)
+            raise
+    os.rename(tf.name, filename)
+    with open(filename + '.json', 'w') as f:
+        json.dump({'url': url,
+                   'etag': response.info().get('ETag'),
+                   'last_modified': response.info().get('Last-Modified'),
+                   'size': size}, f)
+    return filename
+
+
+def fetch_source(source, cache_dir):
+    '''fetch_url for a thread pool, returns (source, filename, error).'''
+    try:
+        return source, fetch_url(source, cache_dir), None
+    except Exception as e:
+        return source, None, e
+
+
+def fetch(sources, cache_dir, threads):
+    '''Fetch the sources in parallel, returns {source: filename}.'''
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(lambda source: fetch_source(source, cache_dir),
+                           sources)
+    finally:
+        pool.close()
+    fetched = {}
+    for source, filename, error in results:
+        if error:
+            sys.stderr.write('Error: Could not access "%s", verify URL correctness.\n'
+                % (str(source),))
+            sys.exit(1)
+        fetched[source] = filename
+    return fetched
+
+
+def parsed_packages(os_platform, source, filename, cache_dir):
+    '''Packages of a fetched source. Parsed packages are kept in
+    cache_dir as a stream of marshal records, so that every source is
+    parsed once for all the databases built from it. The first record
+    identifies the parsed file, the last one is None. The cache is only
+    renamed into place once complete, a cache which still turns out to be
+    broken after some packages were yielded is removed and reported.'''
+    stamp = os.stat(filename)
+    stamp = [os_platform, stamp.st_size, stamp.st_mtime]
+    cached = os.path.join(cache_dir, '%s.%s.packages' % (
+        hashlib.sha1(source).hexdigest(), os_platform))
+    try:
+        f = open(cached, 'rb')
+    except IOError:
+        f = None
+    if f is not None:
+        with f:
+            try:
+                valid = marshal.load(f) == stamp
+            except (EOFError, ValueError, TypeError):
+                valid = False
+            yielded = False
+            while valid:
+                try:
+                    package = marshal.load(f)
+                except (EOFError, ValueError, TypeError):
+                    if not yielded:
+                        break
+                    os.unlink(cached)
+                    raise IOError('Corrupted cache %s of %s, removed it, '
+                                  'please run again' % (cached, source))
+                if package is None:
+                    return
+                yield package
+                yielded = True
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as tf:
+        try:
+            marshal.dump(stamp, tf.file)
+            with open(filename, 'rb') as data:
+                for package in packages_from_source(os_platform, data,
+                                                    source):
+                    marshal.dump(package, tf.file)
+                    yield package
+            marshal.dump(None, tf.file)
+        except BaseException:
+            # including GeneratorExit, a partial cache is never kept
+            os.unlink(tf.name)
+            raise
+    os.rename(tf.name, cached)
+
+
+def debs_from_source(data):
+    package = {}
+    for line in data:
+        line = line.rstrip('\n')
+        if line:
+            unpacked = line.split(': ', 1)
+            if len(unpacked) > 1:
+                package[unpacked[0]] = unpacked[1]
+        elif package:
+            package['Filename'] = package['Filename'].split('/')[-1]
+            yield package
+            package = {}
+    if package:
+        package['Filename'] = package['Filename'].split('/')[-1]
+        yield package
+
+
+def rpms_from_source(data, source):
+    if source.endswith('.sqlite.bz2'):
+        # sqlite needs a file, only the decompressed db is on disk
+        with tempfile.NamedTemporaryFile() as tf:
+            for chunk in decompress(data, bz2.BZ2Decompressor()):
+                tf.write(chunk)
+            tf.flush()
+            db = sqlite3.connect(tf.name)
+            dbc = db.cursor()
+            packagedata = dbc.execute('''
+               SELECT
+                   name,
+                   epoch,
+                   version,
+                   release,
+                   location_href
+               FROM packages
+               ''')
+            for pd in packagedata:
+                if pd[4].split('/')[0] != 'Packages':
+                    #ignore source rpms
+                    continue
+                package = {}
+                package['Package'] = pd[0]
+                if pd[1] != '0':
+                    package['Version'] = pd[1]+':'+pd[2]+'-'+pd[3]
+                else:
+                    package['Version'] = pd[2]+'-'+pd[3]
+                package['Filename'] = pd[4].split('/')[-1]
+                yield package
+            db.close()
+    elif source.endswith('xml.gz'):
+        xmldata = ChunkReader(decompress(
+            data, zlib.decompressobj(zlib.MAX_WBITS | 16)))
+        root = None
+        for event, el in ET.iterparse(xmldata, events=('start', 'end')):
+            if root is None:
+                root = el
+            if event != 'end':
+                continue
+            # strip namespaces, only once the element is complete
+            if '}' in el.tag:
+                el.tag = el.tag.split('}', 1)[1]
+            if el.tag != 'package':
+                continue
+            package = {}
+            p_ep = el.find('version').get('epoch')
+            p_ver = el.find('version').get('ver')
+            p_rel = el.find('version').get('rel')
+            package['Package'] = el.findtext('name')
+            package['Filename'] = el.find('location').get('href').split('/')[-1]
+            if p_ep != '0':
+                package['Version'] = '%s:%s-%s' % (p_ep, p_ver, p_rel)
+            else:
+                package['Version'] = '%s-%s' % (p_ver, p_rel)
+            # parsed packages are dropped, memory use stays flat
+            root.clear()
+            yield package
+    else:
+        print('unknown format of %s' % (source,))
+
+
+def packages_from_source(os_platform, data, source):
+    if os_platform == 'ubuntu':
+        return debs_from_source(data)
+    if os_platform == 'centos':
+        return rpms_from_source(data, source)
+
+
+def get_source_id(dbc, source):
+    r = dbc.execute('''
+        SELECT rowid FROM sources WHERE source = ?
+        ''', (source,)).fetchall()
+    if len(r) == 0:
+        dbc.execute('''
+            INSERT INTO sources (source) VALUES (?)
+            ''', (source,))
+        r = dbc.execute('''
+                SELECT rowid FROM sources
+                WHERE source = ?
+            ''', (source,)).fetchall()
+    return r[0][0]
+
+
+def print_duplicate(source, name, version, found_source, found_mu):
+    found_mu = 'GA' if found_mu == 0 else 'MU%s' % (found_mu,)
+    print('  Duplicate package in %s\n    %s %s\n'
+          '    already provided by %s (%s)\n  Skipping...' % (
+              source,
+              name,
+              version,
+              found_source,
+              found_mu))
+
+
+def connect(filename, release, os_platform, bulk=False):
+    '''Open the output database and start the transaction in which all
+    the layers are added, see commit().'''
+    empty = os.stat(filename).st_size == 0
+    # transactions are handled explicitly, the sqlite3 module would
+    # otherwise commit before every CREATE statement
+    db = sqlite3.connect(filename, isolation_level=None)
+    if bulk:
+        # the output is rebuilt from scratch if anything fails, durability
+        # of the intermediate states does not matter
+        db.execute('PRAGMA journal_mode = MEMORY')
+        db.execute('PRAGMA synchronous = OFF')
+        db.execute('PRAGMA cache_size = -%d' % (256 * 1024))
+    db.execute('BEGIN')
+    if empty:
+        #empty file -> new db, creating tables
+        versionsdb.create_schema(db, release, os_platform)
+    else:
+        versionsdb.upgrade_schema(db, release, os_platform)
+    return db
+
+
+def commit(db):
+    versionsdb.update_package_max(db)
+    db.execute('COMMIT')
+    db.close()
+
+
+def dbgen(db, sources, mu=0, job_id=-1, bulk=False):
+    '''Add a layer (GA or an MU) to the db, sources map source urls to
+    their packages.'''
+    if bulk:
+        return dbgen_bulk(db, sources, mu, job_id)
+    dbc = db.cursor()
+    for source, packages in sources.items():
+        source_id = get_source_id(dbc, source)
+        for package in packages:
+            r = dbc.execute('''
+                SELECT source_id, mu FROM packages
+                WHERE mu = ?
+                      AND package_name = ?
+                      AND package_version = ?
+                      AND package_filename = ?
+                ''', (mu,
+                      package['Package'],
+                      package['Version'],
+                      package['Filename']))
+            pkgs = r.fetchall()
+            if len(pkgs) > 0:
+                r = dbc.execute('''
+                    SELECT source FROM sources
+                    WHERE id = ?
+                    ''', (pkgs[0][0],))
+                found_source = r.fetchone()[0]
+                print_duplicate(source, package['Package'],
+                                package['Version'], found_source,
+                                pkgs[0][1])
+            else:
+                dbc.execute('''
+                    INSERT INTO packages
+                    (
+                        source_id,
+                        job_id,
+                        mu,
+                        package_name,
+                        package_version,
+                        package_filename
+                    ) VALUES (?,?,?,?,?,?)
+                    ''', (source_id,
+                          job_id,
+                          mu,
+                          package['Package'],
+                          package['Version'],
+                          package['Filename']))
+
+
+def dbgen_bulk(db, sources, mu=0, job_id=-1):
+    '''Same as the per-package path of dbgen, but all packages are
+    streamed into a staging table with executemany and copied over
+    with one INSERT OR IGNORE.'''
+    dbc = db.cursor()
+    dbc.execute('''
+        CREATE TEMP TABLE staging
+        (
+            source_id INTEGER,
+            mu INTEGER,
+            package_name TEXT,
+            package_version TEXT,
+            package_filename TEXT
+        )''')
+    for source, packages in sources.items():
+        source_id = get_source_id(dbc, source)
+        dbc.executemany('''
+            INSERT INTO staging
+            (
+                source_id,
+                mu,
+                package_name,
+                package_version,
+                package_filename
+            ) VALUES (?,?,?,?,?)
+            ''', ((source_id,
+                   mu,
+                   package['Package'],
+                   package['Version'],
+                   package['Filename'])
+                  for package in packages))
+    dbc.execute('''
+        CREATE INDEX temp.staging_key
+        ON staging (mu, package_name, package_version, package_filename)
+        ''')
+    # rows which are already in the db or repeat an earlier staging row
+    r = dbc.execute('''
+        SELECT
+            staging.rowid,
+            source.source,
+            staging.package_name,
+            staging.package_version,
+            found_source.source,
+            packages.mu
+        FROM staging
+        JOIN packages USING
+            (mu, package_name, package_version, package_filename)
+        JOIN sources AS source ON source.id = staging.source_id
+        JOIN sources AS found_source
+            ON found_source.id = packages.source_id
+        UNION ALL
+        SELECT
+            staging.rowid,
+            source.source,
+            staging.package_name,
+            staging.package_version,
+            found_source.source,
+            first.mu
+        FROM staging
+        JOIN staging AS first
+            ON first.rowid = (
+                SELECT MIN(s.rowid) FROM staging AS s
+                WHERE s.mu = staging.mu
+                      AND s.package_name = staging.package_name
+                      AND s.package_version = staging.package_version
+                      AND s.package_filename = staging.package_filename)
+        JOIN sources AS source ON source.id = staging.source_id
+        JOIN sources AS found_source
+            ON found_source.id = first.source_id
+        WHERE first.rowid != staging.rowid
+              AND NOT EXISTS (
+                  SELECT 1 FROM packages
+                  WHERE packages.mu = staging.mu
+                        AND packages.package_name = staging.package_name
+                        AND packages.package_version =
+                            staging.package_version
+                        AND packages.package_filename =
+                            staging.package_filename)
+        ORDER BY 1
+        ''')
+    for row in r:
+        print_duplicate(*row[1:])
+    dbc.execute('''
+        INSERT OR IGNORE INTO packages
+        (
+            source_id,
+            job_id,
+            mu,
+            package_name,
+            package_version,
+            package_filename
+        )
+        SELECT
+            source_id,
+            ?,
+            mu,
+            package_name,
+            package_version,
+            package_filename
+        FROM staging
+        ORDER BY rowid
+        ''', (job_id,))
+    dbc.execute('DROP TABLE staging')
+
+def build(output, release, os_platform, layers, fetched, cache_dir,
+          bulk=False, job_id=-1, database=None):
+    '''Build the output db, starting from a copy of the database if one
+    is given, and add the layers, a list of (mu, sources), one after the
+    other in a single connection.'''
+    if database:
+        shutil.copyfile(fetched[database], output)
+    db = connect(output, release, os_platform, bulk)
+    for mu, sources in layers:
+        packages = {}
+        for source in sources:
+            packages[source] = parsed_packages(os_platform, source,
+                                               fetched[source], cache_dir)
+        dbgen(db, packages, mu, job_id, bulk)
+    commit(db)
+
+
+def build_manifest_entry(job):
+    '''Build one db of the manifest, in a worker process.'''
+    entry, fetched, args = job
+    release = str(entry['release'])
+    db_dir = os.path.join(args.output, release)
+    if not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+    layers = []
+    if entry.get('ga'):
+        layers.append((0, entry['ga']))
+    for mu in sorted(entry.get('mu') or {}):
+        layers.append((mu, entry['mu'][mu]))
+    print('%s %s -> db generation...' % (release, entry['os']))
+    # the db is replaced only once all the layers are in
+    with tempfile.NamedTemporaryFile(dir=db_dir, delete=False) as tf:
+        pass
+    try:
+        build(tf.name, release, entry['os'], layers, fetched,
+              args.cache_dir, bulk=args.bulk, job_id=args.job_id,
+              database=entry.get('database'))
+    except BaseException:
+        os.unlink(tf.name)
+        raise
+    output = os.path.join(db_dir, '%s.sqlite' % (entry['os'],))
+    os.chmod(tf.name, 0644)
+    os.rename(tf.name, output)
+    return output
+
+
+def build_manifest(args):
+    '''Build all the dbs of the manifest in parallel, every source is
+    fetched once for all of them.'''
+    with open(args.manifest) as f:
+        manifest = yaml.safe_load(f)
+    sources = set()
+    for entry in manifest:
+        if entry.get('os') not in systems:
+            sys.stderr.write('Error: Unknown OS in %s.\n' % (entry,))
+            return 1
+        if str(entry.get('release')) not in releases:
+            sys.stderr.write('Error: Unknown release in %s.\n' % (entry,))
+            return 1
+        if not entry.get('ga') and not entry.get('database'):
+            sys.stderr.write('Error: Neither ga nor database specified in '
+                             '%s.\n' % (entry,))
+            return 1
+        sources.update(entry.get('ga') or [])
+        for mu_sources in (entry.get('mu') or {}).values():
+            sources.update(mu_sources)
+        if entry.get('database'):
+            sources.add(entry['database'])
+    fetched = fetch(sorted(sources), args.cache_dir, args.threads)
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        outputs = pool.map(build_manifest_entry,
+                           [(entry, fetched, args) for entry in manifest])
+    finally:
+        pool.close()
+        pool.join()
+    for output in outputs:
+        print('Built %s' % (output,))
+
+
 def main(argv=None):
 
     def verify_args():
+        if args.manifest:
+            if not args.output:
+                return 'Output directory not specified.'
+            return
         if not args.os:
             return 'OS not specified.'
         if args.os not in systems:
@@ -49,181 +609,6 @@ def main(argv=None):
         except Exception:
             return 'Cannot write to the output file '+args.output
 
-    def fetch(sources):
-        fetched = {}
-        for source in sources:
-            try:
-                request = urllib2.urlopen(source)
-            except Exception:
-                sys.stderr.write('Error: Could not access "%s", verify URL correctness.\n'
-                    % (str(source),))
-                sys.exit(1)
-            fetched[source] = request.read()
-        return fetched
-
-    def debs_from_source(data):
-        packages = []
-        packagedata = data.split('\n\n')
-        for pd in packagedata:
-            if len(pd) == 0:
-                continue
-            package = {}
-            lines = pd.split('\n')
-            for line in lines:
-                unpacked = line.split(': ', 1)
-                if len(unpacked) > 1:
-                    package[unpacked[0]] = unpacked[1]
-            package['Filename'] = package['Filename'].split('/')[-1]
-            packages.append(package)
-        return packages
-
-    def rpms_from_source(data, source):
-        packages = []
-        with tempfile.NamedTemporaryFile() as tf:
-            if source.endswith('.sqlite.bz2'):
-                tf.write(bz2.decompress(data))
-                tf.flush()
-                db = sqlite3.connect(tf.name)
-                dbc = db.cursor()
-                packagedata = dbc.execute('''
-                   SELECT
-                       name,
-                       epoch,
-                       version,
-                       release,
-                       location_href
-                   FROM packages
-                   ''')
-                for pd in packagedata:
-                    if pd[4].split('/')[0] != 'Packages':
-                        #ignore source rpms
-                        continue
-                    package = {}
-                    package['Package'] = pd[0]
-                    if pd[1] != '0':
-                        package['Version'] = pd[1]+':'+pd[2]+'-'+pd[3]
-                    else:
-                        package['Version'] = pd[2]+'-'+pd[3]
-                    package['Filename'] = pd[4].split('/')[-1]
-                    packages.append(package)
-                db.close()
-            elif source.endswith('xml.gz'):
-                xmldata = zlib.decompress(data, zlib.MAX_WBITS | 16)
-                xmltree = ET.iterparse(StringIO(xmldata))
-                # strip namespaces
-                for _, el in xmltree:
-                    if '}' in el.tag:
-                        el.tag = el.tag.split('}', 1)[1]
-                for pd in xmltree.root:
-                    package = {}
-                    p_ep = pd.find('version').get('epoch')
-                    p_ver = pd.find('version').get('ver')
-                    p_rel = pd.find('version').get('rel')
-                    package['Package'] = pd.findtext('name')
-                    package['Filename'] = pd.find('location').get('href').split('/')[-1]
-                    if p_ep != '0':
-                        package['Version'] = '%s:%s-%s' % (p_ep, p_ver, p_rel)
-                    else:
-                        package['Version'] = '%s-%s' % (p_ver, p_rel)
-                    packages.append(package)
-            else:
-                print('unknown format of %s' % (source,))
-        return packages
-
-    def dbgen(sources, mu=0, job_id=-1):
-        db = sqlite3.connect(args.output)
-        dbc = db.cursor()
-        if os.stat(args.output).st_size == 0:
-            #empty file -> new db, creating tables
-            dbc.execute('''
-                CREATE TABLE sources
-                (
-                    id INTEGER PRIMARY KEY,
-                    source TEXT
-                )''')
-            dbc.execute('''
-                CREATE TABLE versions
-                (
-                    id INTEGER PRIMARY KEY,
-                    source_id INTEGER,
-                    job_id INTEGER,
-                    release TEXT,
-                    mu INTEGER,
-                    os TEXT,
-                    package_name TEXT,
-                    package_version TEXT,
-                    package_filename TEXT
-                )''')
-        for source, data in sources.items():
-            r = dbc.execute('''
-                SELECT rowid FROM sources WHERE source = ?
-                ''', (source,)).fetchall()
-            if len(r) == 0:
-                dbc.execute('''
-                    INSERT INTO sources (source) VALUES (?)
-                    ''', (source,))
-                r = dbc.execute('''
-                        SELECT rowid FROM sources
-                        WHERE source = ? 
-                    ''', (source,)).fetchall()
-            source_id = r[0][0]
-            if args.os == 'ubuntu':
-                packages = debs_from_source(data)
-            if args.os == 'centos':
-                packages = rpms_from_source(data, source)
-            for package in packages:
-                r = dbc.execute('''
-                    SELECT source_id, mu FROM versions
-                    WHERE release = ?
-                          AND mu = ?
-                          AND os = ?
-                          AND package_name = ?
-                          AND package_version = ?
-                          AND package_filename = ?
-                    ''', (args.release,
-                          mu,
-                          args.os,
-                          package['Package'],
-                          package['Version'],
-                          package['Filename']))
-                pkgs = r.fetchall()
-                if len(pkgs) > 0:
-                    found_mu = 'GA' if pkgs[0][1] == 0 else 'MU%s' % (pkgs[0][1])
-                    r = dbc.execute('''
-                        SELECT source FROM sources
-                        WHERE id = ?
-                        ''', (pkgs[0][0],))
-                    found_source = r.fetchone()[0]
-                    print('  Duplicate package in %s\n    %s %s\n'
-                          '    already provided by %s (%s)\n  Skipping...' % (
-                              source,
-                              package['Package'],
-                              package['Version'],
-                              found_source,
-                              found_mu))
-                else:
-                    dbc.execute('''
-                        INSERT INTO versions
-                        (
-                            source_id,
-                            job_id,
-                            release,
-                            mu,
-                            os,
-                            package_name,
-                            package_version,
-                            package_filename
-                        ) VALUES (?,?,?,?,?,?,?,?)
-                        ''', (source_id,
-                              job_id,
-                              args.release,
-                              mu,
-                              args.os,
-                              package['Package'],
-                              package['Version'],
-                              package['Filename']))
-        db.commit()
-
     # validating arguments
     if not argv:
         sys.stderr.write('Error: no parameters specified.\n')
@@ -275,26 +660,68 @@ def main(argv=None):
                                  ))
         parser.add_argument('-j', '--job-id',
                             help='Optional. ID of the current Jenkins job.')
+        parser.add_argument('-b', '--bulk', action='store_true',
+                            help=('Optional. Insert all packages in bulk '
+                                  'within a single transaction, duplicates '
+                                  'are reported after parsing all sources.'
+                                 ))
+        parser.add_argument('-m', '--manifest',
+                            help=('Optional. YAML file listing the dbs to '
+                                  'build, they are built in parallel into '
+                                  'the <release>/<os>.sqlite files of the '
+                                  '--output directory. Every item has '
+                                  '"release", "os", "ga" (list of URLs) '
+                                  'or "database" (URL of a db to start '
+                                  'from) and optionally "mu" (MU number: '
+                                  'list of URLs), the MUs are added in '
+                                  'ascending order. Other options except '
+                                  '-b, -c, -j, -p and -t are ignored.'
+                                 ))
+        parser.add_argument('-p', '--processes', type=int,
+                            default=multiprocessing.cpu_count(),
+                            help=('Optional. Number of dbs built in '
+                                  'parallel with --manifest (default: '
+                                  '%(default)s).'
+                                 ))
+        parser.add_argument('-c', '--cache-dir',
+                            default=os.path.expanduser(
+                                '~/.cache/cudet/generate-db'),
+                            help=('Optional. Directory where downloaded '
+                                  'sources are kept and revalidated on the '
+                                  'next run, along with the parsed '
+                                  'packages (default: %(default)s).'
+                                 ))
+        parser.add_argument('-t', '--threads', type=int, default=8,
+                            help=('Optional. Number of sources downloaded '
+                                  'in parallel (default: %(default)s).'
+                                 ))
 
         args = parser.parse_args(argv[1:])
         args_check_error = verify_args()
         if args_check_error:
             sys.stderr.write('Error: '+args_check_error+'\n')
             return 1
+    if not os.path.isdir(args.cache_dir):
+        os.makedirs(args.cache_dir)
+    if args.manifest:
+        return build_manifest(args)
     # database generation / update
     if not args.updates_source:
         #GA db generation
         print('GA -> db generation...')
-        release_source = fetch(args.release_source)
-        dbgen(sources=release_source, job_id=args.job_id)
+        fetched = fetch(args.release_source, args.cache_dir, args.threads)
+        build(args.output, args.release, args.os,
+              [(0, args.release_source)], fetched, args.cache_dir,
+              bulk=args.bulk, job_id=args.job_id)
     else:
         #MU db update
         print('MU -> db update...')
-        updates_source = fetch(args.updates_source)
-        updates_db = fetch([args.database])[args.database]
-        with open(args.output,'w') as file:
-            file.write(updates_db)
-        dbgen(updates_source, args.mu_number, args.job_id)
+        fetched = fetch(args.updates_source + [args.database],
+                        args.cache_dir, args.threads)
+        build(args.output, args.release, args.os,
+              [(args.mu_number, args.updates_source)], fetched,
+              args.cache_dir, bulk=args.bulk, job_id=args.job_id,
+              database=args.database)
 
 if __name__ == '__main__':
     exit(main(sys.argv))
@@ -6,6 +6,10 @@ import urllib2
 import sqlite3
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from cudet import versionsdb
+
 releases = ['5.1',
             '5.1.1',
             '6.0',
@@ -53,25 +57,9 @@ def main(argv=None):
         dbc = db.cursor()
         if os.stat(args.output).st_size == 0:
             #empty file -> new db, creating tables
-            dbc.execute('''
-                CREATE TABLE sources
-                (
-                    id INTEGER PRIMARY KEY,
-                    source TEXT
-                )''')
-            dbc.execute('''
-                CREATE TABLE versions
-                (
-                    id INTEGER PRIMARY KEY,
-                    source_id INTEGER,
-                    job_id INTEGER,
-                    release TEXT,
-                    mu TEXT,
-                    os TEXT,
-                    package_name TEXT,
-                    package_version TEXT,
-                    package_filename TEXT
-                )''')
+            versionsdb.create_schema(db, args.release, 'ubuntu')
+        else:
+            versionsdb.upgrade_schema(db, args.release, 'ubuntu')
         for source, data in sources.items():
             r = dbc.execute('''
                 SELECT rowid FROM sources WHERE source = ?
@@ -97,15 +85,12 @@ def main(argv=None):
                         package[unpacked[0]] = unpacked[1]
                 package['Filename'] = package['Filename'].split('/')[-1]
                 r = dbc.execute('''
-                    SELECT rowid FROM versions
-                    WHERE release = ?
-                          AND mu = ?
-                          AND os = 'ubuntu'
+                    SELECT rowid FROM packages
+                    WHERE mu = ?
                           AND package_name = ?
                           AND package_version = ?
                           AND package_filename = ?
-                    ''', (args.release,
-                          mu,
+                    ''', (mu,
                           package['Package'],
                           package['Version'],
                           package['Filename']))
@@ -113,25 +98,22 @@ def main(argv=None):
                     print('Duplicate package '+str(package)+', skipping...')
                 else:
                     dbc.execute('''
-                        INSERT INTO versions
+                        INSERT INTO packages
                         (
                             source_id,
                             job_id,
-                            release,
                             mu,
-                            os,
                             package_name,
                             package_version,
                             package_filename
-                        ) VALUES (?,?,?,?,?,?,?,?)
+                        ) VALUES (?,?,?,?,?,?)
                         ''', (source_id,
                               job_id,
-                              args.release,
                               mu,
-                              'ubuntu',
                               package['Package'],
                               package['Version'],
                               package['Filename']))
+        versionsdb.update_package_max(db)
         db.commit()
 
     # validating arguments